@@ -0,0 +1,177 @@
+#!/usr/bin/python
+
+'''
+columnlog.py
+- columnar log files for mmll.py and rawlog.py: NumPy .npy or Parquet
+
+Both formats hold a float64 TimeStamp column in seconds and one float32 column
+per logged variable, named after the variable.  Values not read yet are NaN.
+
+npy     One structured array, readable with numpy.load().  The units, aliases
+        and ECU details go into OUTPUTFILE.json next to it.  The row count in
+        the header is brought up to date on every flush, so the file can be
+        loaded while logging is still running.  Needs numpy.
+parquet Row groups of a fixed number of samples.  Units and aliases are field
+        metadata, the ECU details file metadata.  The file is only readable
+        once it has been closed.  Needs pyarrow.
+
+Copyright 2013 Ted Richardson.
+Distributed under the terms of the GNU General Public License (GPL)
+See LICENSE.txt for licensing information.
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program; if not, write to the Free Software Foundation, Inc.,
+51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+--
+trichard3000
+'''
+
+import time, json, struct
+# These may need to be installed separately
+try:
+   import numpy
+except ImportError:
+   numpy = None
+try:
+   import pyarrow
+   import pyarrow.parquet
+except ImportError:
+   pyarrow = None
+
+formats = [ 'csv', 'npy', 'parquet' ]
+rowgroup = 4096
+
+def columninfo(config):
+   # [ name, unit, alias ] per variable.  Names are made unique, columns need that.
+   columns = []
+   seen = set([ 'TimeStamp' ])
+   for i in range(1,len(config)):
+      name = config[i][0]
+      while name in seen:
+         name = name + '_'
+      seen.add(name)
+      unit = config[i][5]
+      if unit[:1] == '{':
+         unit = unit[1:]
+      if unit[-1:] == '}':
+         unit = unit[:-1]
+      columns = columns + [ [ name, unit, config[i][1] ] ]
+   return columns
+
+def loginfo(config, starttime):
+   # The logheader() details worth keeping with the data
+   return { 'ecufile': config[0][0], 'samplespersecond': config[0][1], 'logspeed': config[0][5],
+            'hwnumber': config[0][6], 'swnumber': config[0][7], 'partnumber': config[0][8],
+            'swversion': config[0][9], 'engineid': config[0][10], 'starttime': starttime }
+
+def tofloat(value):
+   # Slow channels that haven't been read yet come through as ''
+   if value == '':
+      return float('nan')
+   return value
+
+class NpyEmitter:
+   # Same add()/flush() interface as mmll.CsvEmitter.  Rows are filled into a preallocated
+   # block and appended to the file a block at a time.
+   def __init__(self, outfile, config, flushtime=1.0, starttime=None):
+      if numpy is None:
+         raise Exception("npy output requires numpy")
+      if starttime is None:
+         starttime = time.time()
+      self.outfile = outfile
+      columns = columninfo(config)
+      self.dtype = numpy.dtype([ ( 'TimeStamp', '<f8' ) ] + [ ( name, '<f4' ) for name, unit, alias in columns ])
+      self.block = numpy.zeros(rowgroup, dtype=self.dtype)
+      self.rows = 0
+      self.written = 0
+      self.flushtime = flushtime
+      self.lastflush = time.monotonic()
+      sidecar = open(outfile.name + '.json', 'w')
+      json.dump({ 'columns': [ { 'name': name, 'unit': unit, 'alias': alias } for name, unit, alias in columns ],
+                  'log': loginfo(config, starttime) }, sidecar, indent=1)
+      sidecar.close()
+      self.writeheader()
+
+   def writeheader(self):
+      # The row count is padded so the header keeps its size as the count grows
+      header = "{'descr': " + repr(numpy.lib.format.dtype_to_descr(self.dtype)) + ", 'fortran_order': False, 'shape': (" + \
+               str(self.written).ljust(20) + ",), }"
+      header = header + ' ' * (63 - (len(header) + 10) % 64) + '\n'
+      self.outfile.write(b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin1'))
+
+   def add(self, elapsed, values):
+      self.block[self.rows] = tuple([ elapsed ] + [ tofloat(v) for v in values ])
+      self.rows = self.rows + 1
+      if self.rows == rowgroup or time.monotonic() - self.lastflush >= self.flushtime:
+         self.flush()
+
+   def flush(self):
+      if self.rows:
+         self.outfile.write(self.block[:self.rows].tobytes())
+         self.written = self.written + self.rows
+         self.rows = 0
+         end = self.outfile.tell()
+         self.outfile.seek(0)
+         self.writeheader()
+         self.outfile.seek(end)
+      self.outfile.flush()
+      self.lastflush = time.monotonic()
+
+   def close(self):
+      self.flush()
+
+class ParquetEmitter:
+   # Same add()/flush() interface as mmll.CsvEmitter.  Every full block of rows becomes one
+   # row group; flush() doesn't cut row groups short, only close() writes the last one.
+   def __init__(self, outfile, config, flushtime=1.0, starttime=None):
+      if pyarrow is None:
+         raise Exception("parquet output requires pyarrow")
+      if starttime is None:
+         starttime = time.time()
+      columns = columninfo(config)
+      fields = [ pyarrow.field('TimeStamp', pyarrow.float64(), metadata={ 'unit': 'sec.ms' }) ]
+      for name, unit, alias in columns:
+         fields.append(pyarrow.field(name, pyarrow.float32(), metadata={ 'unit': unit, 'alias': alias }))
+      self.schema = pyarrow.schema(fields, metadata={ 'mmll': json.dumps(loginfo(config, starttime)) })
+      self.writer = pyarrow.parquet.ParquetWriter(outfile, self.schema)
+      self.columns = [ [] for field in fields ]
+      self.written = 0
+
+   def add(self, elapsed, values):
+      self.columns[0].append(elapsed)
+      for column, value in zip(self.columns[1:], values):
+         column.append(tofloat(value))
+      if len(self.columns[0]) == rowgroup:
+         self.writegroup()
+
+   def writegroup(self):
+      if self.columns[0]:
+         arrays = [ pyarrow.array(column, type=field.type) for column, field in zip(self.columns, self.schema) ]
+         self.writer.write_table(pyarrow.Table.from_arrays(arrays, schema=self.schema), row_group_size=rowgroup)
+         self.written = self.written + len(self.columns[0])
+         self.columns = [ [] for column in self.columns ]
+
+   def flush(self):
+      pass
+
+   def close(self):
+      self.writegroup()
+      self.writer.close()
+
+def openemitter(format, outfile, config, flushtime=1.0, starttime=None):
+   # The emitter for a columnar format.  outfile has to be a binary file.
+   if format == 'npy':
+      return NpyEmitter(outfile, config, flushtime, starttime)
+   if format == 'parquet':
+      return ParquetEmitter(outfile, config, flushtime, starttime)
+   raise Exception("unknown output format", format)
@@ -0,0 +1,215 @@
+#!/usr/bin/python
+
+'''
+compresslog.py
+- compressed, rotating log files for mmll.py, written on a background thread
+
+CompressedFile takes the place of the open output file.  Writes are collected
+into chunks; a chunk is handed to the compression thread through a bounded
+queue once it reaches chunksize bytes or chunktime seconds.  Every chunk is
+compressed on its own into a complete gzip member, xz stream or zstd frame
+and flushed to disk, so a power cut only loses the chunk being filled and the
+ones still queued (queuesize at most), and the file still decompresses with
+the usual tools.  Files are rotated by size or age once they hold some data,
+their age counting from the first data frame: the first keeps the given name,
+the next ones get -002, -003, ... before the extensions.  Whatever keepheader() marked is repeated at the top of every
+file, so each one stands on its own.
+
+gzip and xz come with Python, zstd needs the zstandard module.
+
+Copyright 2013 Ted Richardson.
+Distributed under the terms of the GNU General Public License (GPL)
+See LICENSE.txt for licensing information.
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program; if not, write to the Free Software Foundation, Inc.,
+51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+--
+trichard3000
+'''
+
+import os, io, time, queue, threading, gzip, lzma
+# This may need to be installed separately
+try:
+   import zstandard
+except ImportError:
+   zstandard = None
+
+methods = [ 'gzip', 'zstd', 'xz' ]
+extensions = { 'gzip': '.gz', 'zstd': '.zst', 'xz': '.xz' }
+
+def compressor(method):
+   # Returns a function that turns one chunk into a complete, independently readable frame
+   if method == 'gzip':
+      return lambda data: gzip.compress(data, 6)
+   if method == 'xz':
+      return lambda data: lzma.compress(data, preset=6)
+   if method == 'zstd':
+      if zstandard is None:
+         raise Exception("zstd compression requires zstandard")
+      return zstandard.ZstdCompressor(level=3).compress
+   raise Exception("unknown compression method", method)
+
+def logname(name, method, number):
+   # The file name for the given file of a rotated log
+   if not name.endswith(extensions[method]):
+      name = name + extensions[method]
+   if number <= 1:
+      return name
+   head, tail = os.path.split(name)
+   dot = tail.find('.')
+   if dot <= 0:
+      dot = len(tail)
+   return os.path.join(head, tail[:dot] + '-' + str(number).rjust(3, '0') + tail[dot:])
+
+class CompressedFile:
+
+   def __init__(self, name, method, chunksize=1048576, chunktime=10.0, rotatesize=0, rotatetime=0, queuesize=16):
+      # rotatesize in compressed bytes and rotatetime in seconds, 0 never rotates
+      self.compress = compressor(method)
+      self.basename = name
+      self.method = method
+      self.chunksize = chunksize
+      self.chunktime = chunktime
+      self.rotatesize = rotatesize
+      self.rotatetime = rotatetime
+      self.pending = bytearray()
+      self.chunkstart = time.monotonic()
+      self.header = b''
+      self.queue = queue.Queue(queuesize)
+      self.highwater = 0
+      self.errors = []
+      self.rawbytes = 0
+      self.packedbytes = 0
+      self.number = 0
+      self.file = None
+      self.name = None
+      self.nextfile()
+      self.thread = threading.Thread(target=self.compressloop, name="mmll-compress", daemon=True)
+      self.thread.start()
+
+   def nextfile(self):
+      # Runs on the compression thread once logging has started
+      if self.file is not None:
+         self.file.close()
+      self.number = self.number + 1
+      self.name = logname(self.basename, self.method, self.number)
+      self.file = open(self.name, 'wb')
+      self.filesize = 0
+      self.opened = None          # when the first data frame went in
+      if self.header:
+         self.writeframe(self.header)
+
+   def writeframe(self, data):
+      frame = self.compress(data)
+      self.file.write(frame)
+      self.file.flush()
+      os.fsync(self.file.fileno())
+      self.filesize = self.filesize + len(frame)
+      self.rawbytes = self.rawbytes + len(data)
+      self.packedbytes = self.packedbytes + len(frame)
+
+   def compressloop(self):
+      try:
+         while True:
+            chunk = self.queue.get()
+            if chunk is None:
+               break
+            if chunk is not self.header:
+               # A file with nothing but the header in it is never rotated
+               if self.opened is not None and \
+                  ((self.rotatesize > 0 and self.filesize >= self.rotatesize) or
+                   (self.rotatetime > 0 and time.monotonic() - self.opened >= self.rotatetime)):
+                  self.nextfile()
+               if self.opened is None:
+                  self.opened = time.monotonic()
+            self.writeframe(chunk)
+      except Exception as e:
+         self.errors.append(e)
+      self.file.close()
+
+   def enqueue(self, item):
+      # A full queue holds up the caller rather than losing log data, but only for as
+      # long as the compression thread is still there to empty it
+      while True:
+         if self.errors:
+            raise self.errors[0]
+         if not self.thread.is_alive():
+            raise Exception("compression thread stopped", self.name)
+         try:
+            self.queue.put(item, timeout=0.1)
+            return
+         except queue.Full:
+            pass
+
+   def handoff(self):
+      # Passes the pending chunk to the compression thread
+      if self.errors:
+         raise self.errors[0]
+      if self.pending:
+         self.enqueue(bytes(self.pending))
+         self.highwater = max(self.highwater, self.queue.qsize())
+         self.pending = bytearray()
+      self.chunkstart = time.monotonic()
+
+   def write(self, data):
+      if isinstance(data, str):
+         data = data.encode()
+      self.pending += data
+      if len(self.pending) >= self.chunksize or time.monotonic() - self.chunkstart >= self.chunktime:
+         self.handoff()
+      return len(data)
+
+   def keepheader(self):
+      # Everything written so far goes at the top of every rotated file too.  It is
+      # queued as is, so the compression thread can tell it from the data.
+      if self.errors:
+         raise self.errors[0]
+      self.header = bytes(self.pending)
+      self.pending = bytearray()
+      if self.header:
+         self.enqueue(self.header)
+      self.chunkstart = time.monotonic()
+
+   def flush(self):
+      # Frames are cut by size and time only, so the emitters' frequent flushes don't
+      # shrink them.  close() writes out the rest.
+      if self.errors:
+         raise self.errors[0]
+
+   def close(self):
+      if self.thread.is_alive():
+         self.handoff()
+         self.enqueue(None)
+         self.thread.join()
+      if self.errors:
+         raise self.errors[0]
+
+   def report(self):
+      ratio = 0.0
+      if self.packedbytes > 0:
+         ratio = self.rawbytes / self.packedbytes
+      return "Compressed " + str(self.rawbytes) + " bytes to " + str(self.packedbytes) + " (" + str(round(ratio, 1)) + \
+             ":1) in " + str(self.number) + " file(s), queue high water: " + str(self.highwater)
+
+def openread(name):
+   # Opens a log or capture for reading, compressed or not, going by the extension
+   if name.endswith('.gz'):
+      return gzip.open(name, 'rb')
+   if name.endswith('.xz'):
+      return lzma.open(name, 'rb')
+   if name.endswith('.zst'):
+      if zstandard is None:
+         raise Exception("zstd compression requires zstandard")
+      return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(name, 'rb'), read_across_frames=True))
+   return open(name, 'rb')
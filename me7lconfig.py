@@ -26,14 +26,17 @@ trichard3000
 '''
 
 #from __future__ import print_function
-import sys, time, re
+import sys, os, time, re, json, hashlib
 
 
-def parseconfigfile(pf):
+def parseconfigfile(pf, rates=None):
+   # rates, if given, is filled with the per-variable sample rates from "@N" fields:
+   #    fuel_temp   FuelTemp   @1     ; read once a second
    listout = []
    # cfglistout: ECUfile, Samples, Version, Connect, Communicate, LogSpeed,
    #       ...   HWNumber, SWNumber, PartNumber, SWVersion, EngineId
    cfglistout = [ '', '', '', '', '', '', '', '', '', '', '' ]
+   ecuindex = None
    cfgfile = open(pf)
    for line in cfgfile:
       lineout = []
@@ -50,6 +53,13 @@ def parseconfigfile(pf):
                else:
                   parseline = cfgout.strip()  # is there isn't a ";" pull whole line
 
+               # Pull out an "@N" sample rate, wherever it is on the line
+               ratefield = None
+               for field in parseline.split():
+                  if field[0] == '@':
+                     ratefield = field[1:]
+                     parseline = parseline.replace(field, '', 1).strip()
+
                secondfieldstart = parseline.find(' ')
                if secondfieldstart != -1:
                   firstfield = parseline[:secondfieldstart]
@@ -68,7 +78,12 @@ def parseconfigfile(pf):
                elif lineout[0] == 'SamplesPerSecond':
                   cfglistout[1] = lineout[1]
                else:
-                  listrecord = geteculine(cfglistout[0], lineout[0])
+                  # The ecu file is read once, the first time a variable needs it
+                  if ecuindex is None:
+                     ecuindex = parseecufile(cfglistout[0])
+                  if lineout[0] not in ecuindex[1]:
+                     raise Exception("variable not found in ecu file", lineout[0], cfglistout[0])
+                  listrecord = list(ecuindex[1][lineout[0]])
 
                   # Cleanup curly brackets around aliases
                   if listrecord[1][0] == '{':
@@ -80,22 +95,60 @@ def parseconfigfile(pf):
                      if lineout[1] != "":
                         listrecord[1] = lineout[1]
                   listout = listout + [ listrecord ]
+                  if ratefield is not None:
+                     # A rate has to be a positive number of samples per second
+                     try:
+                        rate = float(ratefield)
+                     except ValueError:
+                        rate = 0.0
+                     if not 0 < rate < float('inf'):
+                        raise Exception("bad sample rate", lineout[0], '@' + ratefield)
+                     if rates is not None:
+                        rates[lineout[0]] = rate
+
+   if ecuindex is None:
+      ecuindex = parseecufile(cfglistout[0])
+   ecusettings = ecuindex[0]
+   cfglistout[2] = ecusettings.get('Version', '')
+   cfglistout[3] = ecusettings.get('Connect', '')
+   cfglistout[4] = ecusettings.get('Communicate', '')
+   cfglistout[5] = ecusettings.get('LogSpeed', '')
+   cfglistout[6] = ecusettings.get('HWNumber', '')[1:-1]
+   cfglistout[7] = ecusettings.get('SWNumber', '')[1:-1]
+   cfglistout[8] = ecusettings.get('PartNumber', '')[1:-1]
+   cfglistout[9] = ecusettings.get('SWVersion', '')[1:-1]
+   cfglistout[10] = ecusettings.get('EngineId', '')[1:-1]
+
+   listout = [ cfglistout ] + listout
+   cfgfile.close()
+   return listout
 
-   ecufile = open(cfglistout[0])
+def parseecufile(ef):
+   # Reads the whole ecu file in one pass.  Returns [ settings, variables ] where settings
+   # maps the "Key = value" entries (Connect, LogSpeed, HWNumber, ...) to their values and
+   # variables maps each variable name to its comma separated fields.
+   settings = {}
+   variables = {}
+   ecufile = open(ef)
    for line in ecufile:
-      lineout = []
-      firstfield = ""
-      secondfield = ""
       cfgout = line.replace('\t'," ").strip()
 
       if cfgout != '':  # if the line isn't empty
-         if cfgout.strip()[0] != '[':  # if the field doesn't start w '['
+         if cfgout[0] != '[':  # if the field doesn't start w '['
             firstfieldlen = cfgout.find(';')  # find if there's a ";"
             if firstfieldlen != 0:  # if the ";" isn't first
+               if ',' in line:
+                  # Variable definition, first one with a given name wins
+                  varinfo = re.split(',',line)
+                  for i in range(len(varinfo)):
+                     varinfo[i] = varinfo[i].strip()
+                  if varinfo[0] != '' and varinfo[0] not in variables:
+                     variables[varinfo[0]] = varinfo
+
                if firstfieldlen != -1:   # if there is a ";" somewhere
                   parseline = cfgout[:firstfieldlen].strip()  # pull up to ";"
                else:
-                  parseline = cfgout.strip()  # is there isn't a ";" pull whole$
+                  parseline = cfgout.strip()  # is there isn't a ";" pull whole line
 
                secondfieldstart = parseline.find(' ')
                if secondfieldstart != -1:
@@ -106,50 +159,18 @@ def parseconfigfile(pf):
                   secondfieldlen = secondfield.find(';')
                   if secondfieldlen > 0:
                      secondfield = secondfield[:secondfieldlen].strip()
-               else:
-                  firstfield = parseline
-                  secondfield = ""
-               lineout = [ firstfield ] + [ secondfield ]
-
-               if lineout[0] == 'Version':
-                  cfglistout[2] = lineout[1]
-               elif lineout[0] == 'Connect':
-                  cfglistout[3] = lineout[1]
-               elif lineout[0] == 'Communicate':
-                  cfglistout[4] = lineout[1]
-               elif lineout[0] == 'LogSpeed':
-                  cfglistout[5] = lineout[1]
-               elif lineout[0] == 'HWNumber':
-                  cfglistout[6] = lineout[1][1:-1]
-               elif lineout[0] == 'SWNumber':
-                  cfglistout[7] = lineout[1][1:-1]
-               elif lineout[0] == 'PartNumber':
-                  cfglistout[8] = lineout[1][1:-1]
-               elif lineout[0] == 'SWVersion':
-                  cfglistout[9] = lineout[1][1:-1]
-               elif lineout[0] == 'EngineId':
-                  cfglistout[10] = lineout[1][1:-1]
-
-   listout = [ cfglistout ] + listout
-   cfgfile.close()
-   return listout
+                  settings[firstfield] = secondfield
+   ecufile.close()
+   return [ settings, variables ]
 
 def geteculine(gf, value):
-   varinfo = []
-   match = False
-   ecufile = open(gf)
-   for line in ecufile:
-      if line[:len(value)] == value:
-         varinfo = re.split(',',line)
-         #insert alias from CFG file
-         for i in range(len(varinfo)):
-            varinfo[i] = varinfo[i].strip()
-         break
-   ecufile.close()
-   return varinfo
+   # Fields of one variable from the ecu file.  Empty if it isn't defined.
+   return list(parseecufile(gf)[1].get(value, []))
 
-def logheader(config):
+def logheader(config, starttime=None, columns=None):
    #  Creates headers for the log file from the config files.
+   #  starttime is only given when the log is written after the fact, columns
+   #  when logcolumns() output is already at hand.
    headers = [ '' ]
    headers = headers + [ ''.ljust(83,chr(0x23)) ]
    headers = headers + [ 'Logfile created by ME7-Logger Clone: ' + sys.argv[0] ]
@@ -170,12 +191,21 @@ def logheader(config):
    headers = headers + [ 'Used speed is:   ' + config[0][5] + ' baud' ]
    headers = headers + [ 'Used mode is:    ' + config[0][4] + '              * Disabled *']
 
-   t = time.localtime(time.time())
+   if starttime is None:
+      starttime = time.time()
+   t = time.localtime(starttime)
    timestamp = str(t[2]).rjust(2,'0') + '.' + str(t[1]).rjust(2,'0') + '.' + str(t[0]) + ' ' 
    timestamp = timestamp + str(t[3]).rjust(2,'0') + ':' + str(t[4]).rjust(2,'0') + ':' + str(t[5]).rjust(2,'0')  
    headers = headers + [ 'Log started at:  ' + timestamp ]
    headers = headers + [ '' ]
 
+   if columns is None:
+      columns = logcolumns(config)
+   headers = headers + columns
+   return headers
+
+def logcolumns(config):
+   #  The three column header lines: names, units and aliases.
    header1 = "TimeStamp, "
    header2 = "sec.ms, "
    header3 = "Time, "
@@ -192,8 +222,22 @@ def logheader(config):
          header1 = header1 + ', '
          header2 = header2 + ', '
          header3 = header3 + ', '
-   headers = headers + [ header1 ] + [ header2 ] + [ header3 ]
-   return headers
+   return [ header1 ] + [ header2 ] + [ header3 ]
+
+def splitrates(config, rates):
+   # Splits the variables into the ones logged in every record and the ones with a
+   # sample rate below SamplesPerSecond.  Returns [ fastconfig, slowrows ], fastconfig
+   # sharing config[0].
+   samples = float(config[0][1] or 0)
+   fastconfig = [ config[0] ]
+   slowrows = []
+   for i in range(1,len(config)):
+      rate = rates.get(config[i][0])
+      if rate is not None and (samples <= 0 or rate < samples):
+         slowrows = slowrows + [ config[i] ]
+      else:
+         fastconfig = fastconfig + [ config[i] ]
+   return [ fastconfig, slowrows ]
 
 def loglocations(config):
    # Parses the config info and creates the byte list to tell the ECU the memory locations to log.
@@ -211,6 +255,147 @@ def loglocations(config):
       logpacketsize = logpacketsize + int(size)
    return [ sendlist, logpacketsize ]
  
+
+# One setuplogrecord() frame carries 0xB7 0x03 and three address bytes per variable, and
+# one log record frame 0xF7 and the data, both behind a single length byte
+maxlogvariables = 84
+maxrecordbytes = 254
+
+def splitlayouts(config):
+   # Splits the variables, in order, into as few log record layouts as the frame limits
+   # allow.  Returns a list of configs, each sharing config[0].
+   layouts = []
+   layout = [ config[0] ]
+   size = 0
+   for i in range(1,len(config)):
+      if len(layout) > maxlogvariables or size + int(config[i][3]) > maxrecordbytes:
+         layouts = layouts + [ layout ]
+         layout = [ config[0] ]
+         size = 0
+      layout = layout + [ config[i] ]
+      size = size + int(config[i][3])
+   return layouts + [ layout ]
+
+# Bus time of one extra request/response turnaround, in bytes, on top of the frames
+turnaroundbytes = 12
+# Unused bytes a block read may span to join two runs of variables
+maxgapbytes = 4
+# Largest block read planned.  ECUs cap readmembyaddr() well below what a frame could
+# carry (memdump.py has to find out how far), and a rejected block would end the log,
+# so blocks stay small enough for any of them to take.
+maxblockbytes = 32
+
+def layoutcost(layouts):
+   # Bytes on the bus per log line for reading these record layouts.  Switching between
+   # layouts costs a setuplogrecord() per layout per line.
+   cost = 0
+   for layout in layouts:
+      cost = cost + 6 + sum([ int(row[3]) for row in layout[1:] ]) + turnaroundbytes
+      if len(layouts) > 1:
+         cost = cost + 4 + 3 * (len(layout) - 1) + 3 + turnaroundbytes
+   return cost
+
+def blockcost(span):
+   # Bytes on the bus for one readmembyaddr() of span bytes: 7 byte request, 3 + span reply
+   return 10 + span + turnaroundbytes
+
+def planreads(config):
+   # Works out how to read the logged variables with the fewest bytes on the bus.  Runs of
+   # adjacent or overlapping variables are candidates for a single readmembyaddr() block,
+   # and one is taken out of the log record whenever that makes the whole line cheaper.
+   # Returns { 'layouts': setuplogrecord() payloads, 'blocks': [ address, span ] reads,
+   # 'slices': [ piece, start, end ] per variable in config order }, where piece counts
+   # the layouts first, then the blocks.
+   variables = sorted([ ( int(config[i][2],16), int(config[i][3]), i ) for i in range(1,len(config)) ])
+   runs = []
+   for address, size, i in variables:
+      if runs and address <= runs[-1][0] + runs[-1][1] + maxgapbytes and \
+            max(runs[-1][1], address + size - runs[-1][0]) <= maxblockbytes:
+         runs[-1][1] = max(runs[-1][1], address + size - runs[-1][0])
+         runs[-1][2].append(i)
+      else:
+         runs.append([ address, size, [ i ] ])
+
+   inblock = set()
+   blocks = []
+   cost = layoutcost(splitlayouts(config))
+   for address, span, members in sorted([ run for run in runs if len(run[2]) > 1 ], key=lambda run: -len(run[2])):
+      rest = [ config[0] ] + [ config[i] for i in range(1,len(config)) if i not in inblock and i not in members ]
+      newcost = sum([ blockcost(block[1]) for block in blocks ]) + blockcost(span)
+      if len(rest) > 1:
+         newcost = newcost + layoutcost(splitlayouts(rest))
+      if newcost < cost:
+         cost = newcost
+         blocks.append([ address, span ])
+         inblock.update(members)
+
+   recorded = [ config[0] ] + [ config[i] for i in range(1,len(config)) if i not in inblock ]
+   layouts = []
+   if len(recorded) > 1:
+      layouts = splitlayouts(recorded)
+   # Where every variable ends up once the pieces are read
+   where = {}
+   for piece in range(len(layouts)):
+      offset = 0
+      for row in layouts[piece][1:]:
+         where[id(row)] = [ piece, offset, offset + int(row[3]) ]
+         offset = offset + int(row[3])
+   for i in inblock:
+      for piece in range(len(blocks)):
+         address, span = blocks[piece]
+         start = int(config[i][2],16) - address
+         if 0 <= start and start + int(config[i][3]) <= span:
+            where[id(config[i])] = [ len(layouts) + piece, start, start + int(config[i][3]) ]
+   return { 'layouts': [ loglocations(layout)[0] for layout in layouts ], 'blocks': blocks,
+            'slices': [ where[id(config[i])] for i in range(1,len(config)) ], 'cost': cost }
+
+cacheversion = 5
+
+def filehash(hf):
+   hashfile = open(hf, 'rb')
+   digest = hashlib.sha256(hashfile.read()).hexdigest()
+   hashfile.close()
+   return digest
+
+def defaultcachedir():
+   return os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'mmll')
+
+def compileconfig(pf, cachedir=None):
+   # Everything the logger needs from the cfg and ecu files: the parseconfigfile() table,
+   # the loglocations() payload and record size, the planreads() layouts and block reads,
+   # the logcolumns() header lines and the per-variable sample rates.
+   # With a cachedir the result is stored under the hash of the cfg file and reused as long
+   # as neither the cfg nor the ecu file it names have changed.
+   cachefile = None
+   if cachedir is not None:
+      cachefile = os.path.join(cachedir, filehash(pf) + '.json')
+      try:
+         cached = open(cachefile)
+         compiled = json.load(cached)
+         cached.close()
+         if compiled['version'] == cacheversion and compiled['ecuhash'] == filehash(compiled['config'][0][0]):
+            return compiled
+      except (OSError, ValueError, KeyError, IndexError):
+         pass
+
+   rates = {}
+   config = parseconfigfile(pf, rates)
+   compiled = { 'version': cacheversion, 'ecuhash': filehash(config[0][0]), 'config': config,
+                'locations': loglocations(config), 'plan': planreads(config),
+                'columns': logcolumns(config), 'rates': rates }
+
+   if cachefile is not None:
+      # Write then rename, so a power cut never leaves half a cache file behind
+      try:
+         os.makedirs(cachedir, exist_ok=True)
+         tmpfile = cachefile + '.' + str(os.getpid())
+         cached = open(tmpfile, 'w')
+         json.dump(compiled, cached)
+         cached.close()
+         os.replace(tmpfile, cachefile)
+      except OSError:
+         pass
+   return compiled
  
 def main():
    print('loading ' + sys.argv[0])
@@ -0,0 +1,374 @@
+#!/usr/bin/python
+
+'''
+memdump.py
+- reads ECU memory to a file with readmembyaddr()
+
+usage: memdump.py [-h] -c CONFIGFILE -a ADDRESS -l LENGTH -o OUTPUTFILE
+                  [--resume | -w] [-n CYCLES] [--chunk CHUNK]
+                  [-d {0,1,2,3,4}]
+
+optional arguments:
+  -h, --help            show this help message and exit
+  -c CONFIGFILE, --configfile CONFIGFILE
+                        The logging config file, for the Connect and LogSpeed
+                        settings
+  -a ADDRESS, --address ADDRESS
+                        First address to read, e.g. 0x380000
+  -l LENGTH, --length LENGTH
+                        Number of bytes to read, e.g. 0x10000
+  -o OUTPUTFILE, --outputfile OUTPUTFILE
+                        The binary dump file
+  --resume              Carry on from the end of an existing OUTPUTFILE
+  -w, --watch           Read the range over and over and write only the bytes
+                        that changed to a delta OUTPUTFILE
+  -n CYCLES, --cycles CYCLES
+                        With --watch, stop after this many reads of the range
+  --chunk CHUNK         Largest read to try; the ECU may take less
+  -d {0,1,2,3,4}, --debug {0,1,2,3,4}
+                        Increase the Debug Level (experimental)
+
+The dump asks for the biggest block a request can carry and halves it whenever
+the ECU turns the size down, then homes in on the largest size it accepts.  Busy
+answers are retried on the same block and responsePending is waited out, so a
+hiccup never restarts the dump.  Every block is flushed to the file as it
+arrives, which is what --resume relies on.
+
+--watch is for finding unknown variables.  The delta file starts with a magic
+string and a length-prefixed JSON header (address, length, start time), then
+one entry per read of the range: an 8 byte nanosecond timestamp and a 4 byte
+count of changed ranges, each a 4 byte offset, a 4 byte length and the new
+bytes.  The first entry holds the whole range.  At the end the addresses that
+changed most often are listed.
+
+Copyright 2013 Ted Richardson.
+Distributed under the terms of the GNU General Public License (GPL)
+See LICENSE.txt for licensing information.
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program; if not, write to the Free Software Foundation, Inc.,
+51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+--
+trichard3000
+'''
+
+import sys, os, time, argparse, struct, json
+import pylibme7
+from me7lconfig import parseconfigfile, loglocations
+# Only needed for faster snapshot diffs.  This may need to be installed separately
+try:
+   import numpy
+except ImportError:
+   numpy = None
+
+# 0x63 and the data share the response length byte
+maxchunk = 254
+# Negative responses that mean the ECU won't hand over that many bytes at once
+sizerejects = [ "requestOutOfRange", "canNotUploadNumberOfBytesRequested",
+                "subFunctionNotSupported / invalidFormat", "illegalByteCountInBlockTransfer" ]
+
+class MemoryDump:
+   # Copies length bytes of ECU memory from address into outfile, starting offset bytes in
+
+   def __init__(self, ecu, address, length, outfile, offset=0, chunk=maxchunk, progress=None):
+      self.ecu = ecu
+      self.address = address
+      self.length = length
+      self.outfile = outfile
+      self.offset = offset
+      # Largest read the ECU took so far, and the smallest it turned down
+      self.chunk = 0
+      self.toolarge = min(chunk, maxchunk) + 1
+      self.progress = progress
+      self.retries = 10
+      self.busy = 0
+      self.timeouts = 0
+      self.requests = 0
+      self.startoffset = offset
+      self.start = time.monotonic()
+      self.shown = 0.0
+
+   def nextsize(self):
+      # Homes in on the largest size the ECU accepts, halfway between what worked and what didn't
+      if self.chunk == 0:
+         return self.toolarge - 1
+      return max(self.chunk, (self.chunk + self.toolarge) // 2)
+
+   def readchunk(self, address, size):
+      # Returns size bytes from address.  Busy answers and timeouts are tried again as they
+      # are, size rejections again at half the size.
+      attempts = 0
+      while True:
+         self.requests = self.requests + 1
+         try:
+            response = self.ecu.readmembyaddr([ (address >> 16) & 0xFF, (address >> 8) & 0xFF, address & 0xFF, size ])
+            if response[1] != 0x63 or len(response) != size + 2:
+               raise Exception("unexpectedResponse", response)
+            self.chunk = max(self.chunk, size)
+            return bytes(response[2:])
+         except pylibme7.EcuTimeout:
+            self.ecu.clearrecv()
+            self.timeouts = self.timeouts + 1
+            attempts = attempts + 1
+            # A long answer that keeps getting lost may be too long for the line
+            if attempts % 3 == 0 and size > 1:
+               size = size // 2
+         except Exception as e:
+            if e.args[0] == "busyRepeatRequest":
+               self.busy = self.busy + 1
+               attempts = attempts + 1
+               time.sleep(0.01 * attempts)
+            elif e.args[0] in sizerejects and size > 1:
+               if size > self.chunk:
+                  self.toolarge = min(self.toolarge, size)
+               size = size // 2
+               continue
+            else:
+               raise e
+         if attempts > self.retries:
+            raise Exception("readFailed", address, size)
+
+   def run(self):
+      # Reads until the range is done.  Returns the number of bytes in the file.
+      while self.offset < self.length:
+         data = self.readchunk(self.address + self.offset, min(self.nextsize(), self.length - self.offset))
+         self.outfile.write(data)
+         self.outfile.flush()
+         self.offset = self.offset + len(data)
+         self.show()
+      self.show(True)
+      return self.offset
+
+   def rate(self):
+      # Bytes per second read by this run
+      elapsed = time.monotonic() - self.start
+      if elapsed <= 0:
+         return 0.0
+      return (self.offset - self.startoffset) / elapsed
+
+   def show(self, done=False):
+      # Progress line, a few times a second at most
+      if self.progress is None:
+         return
+      now = time.monotonic()
+      if not done and now - self.shown < 0.2:
+         return
+      self.shown = now
+      rate = self.rate()
+      eta = 0
+      if rate > 0:
+         eta = int((self.length - self.offset) / rate)
+      self.progress.write('\r' + hex(self.address + self.offset) + "  " + str(self.offset) + "/" + str(self.length) +
+                          " bytes  " + str(round(100.0 * self.offset / max(self.length, 1), 1)).rjust(5) + "%  " +
+                          str(int(rate)) + " B/s  chunk " + str(self.chunk) + "  eta " + str(eta) + "s ")
+      if done:
+         self.progress.write('\n')
+      self.progress.flush()
+
+   def report(self):
+      return "Requests: " + str(self.requests) + "  busy: " + str(self.busy) + "  timeouts: " + str(self.timeouts) + \
+             "  chunk: " + str(self.chunk) + "  rate: " + str(int(self.rate())) + " B/s"
+
+deltamagic = b'MMLLDLT1'
+deltacycle = struct.Struct('<QI')
+deltarange = struct.Struct('<II')
+# Unchanged bytes between two changes cost less in the file than another range header
+mergegap = deltarange.size
+
+def changedranges(current, previous):
+   # Returns [ start, end ) pairs of the bytes that differ between two equal length buffers
+   if numpy is not None:
+      changed = numpy.flatnonzero(numpy.frombuffer(current, dtype=numpy.uint8) != numpy.frombuffer(previous, dtype=numpy.uint8))
+      if len(changed) == 0:
+         return []
+      # Same rule as below: a break wherever more than mergegap unchanged bytes sit between two changes
+      breaks = numpy.flatnonzero(numpy.diff(changed) > mergegap + 1)
+      starts = changed[numpy.concatenate(([ 0 ], breaks + 1))]
+      ends = changed[numpy.concatenate((breaks, [ len(changed) - 1 ]))] + 1
+      return [ [ int(start), int(end) ] for start, end in zip(starts, ends) ]
+   # memoryview comparisons skip the unchanged stretches 64 bytes at a time
+   cur = memoryview(current)
+   prev = memoryview(previous)
+   ranges = []
+   for block in range(0, len(cur), 64):
+      if cur[block : block + 64] == prev[block : block + 64]:
+         continue
+      for i in range(block, min(block + 64, len(cur))):
+         if cur[i] != prev[i]:
+            if ranges and i - ranges[-1][1] <= mergegap:
+               ranges[-1][1] = i + 1
+            else:
+               ranges.append([ i, i + 1 ])
+   return ranges
+
+class MemoryWatch(MemoryDump):
+   # Reads the range over and over into a preallocated snapshot and writes what changed
+   # since the last read to a delta file
+
+   def __init__(self, ecu, address, length, deltafile, chunk=maxchunk, progress=None):
+      MemoryDump.__init__(self, ecu, address, length, deltafile, 0, chunk, progress)
+      self.current = bytearray(length)
+      self.previous = bytearray(length)
+      self.cycles = 0
+      self.changes = [ 0 ] * length
+      self.lastchanged = 0
+      self.written = 0
+      header = json.dumps({ 'address': address, 'length': length, 'starttime': time.time() }).encode()
+      self.outfile.write(deltamagic + struct.pack('<I', len(header)) + header)
+      self.startns = time.perf_counter_ns()
+
+   def readwindow(self):
+      offset = 0
+      while offset < self.length:
+         data = self.readchunk(self.address + offset, min(self.nextsize(), self.length - offset))
+         self.current[offset : offset + len(data)] = data
+         offset = offset + len(data)
+      return time.perf_counter_ns() - self.startns
+
+   def run(self, cycles=0):
+      # Reads the range cycles times, or until ctrl-c with 0.  Returns the number of reads.
+      while cycles <= 0 or self.cycles < cycles:
+         elapsedns = self.readwindow()
+         if self.cycles == 0:
+            ranges = [ [ 0, self.length ] ]
+         else:
+            ranges = changedranges(self.current, self.previous)
+         entry = bytearray(deltacycle.pack(elapsedns, len(ranges)))
+         self.lastchanged = 0
+         for start, end in ranges:
+            entry += deltarange.pack(start, end - start) + self.current[start:end]
+            self.lastchanged = self.lastchanged + end - start
+            if self.cycles > 0:
+               # Ranges take in short unchanged gaps, only count the bytes that moved
+               for i in range(start, end):
+                  if self.current[i] != self.previous[i]:
+                     self.changes[i] = self.changes[i] + 1
+         self.outfile.write(entry)
+         self.written = self.written + len(entry)
+         self.current, self.previous = self.previous, self.current
+         self.cycles = self.cycles + 1
+         self.show()
+      self.outfile.flush()
+      return self.cycles
+
+   def rate(self):
+      elapsed = time.monotonic() - self.start
+      if elapsed <= 0:
+         return 0.0
+      return self.cycles * self.length / elapsed
+
+   def show(self, done=False):
+      if self.progress is None:
+         return
+      now = time.monotonic()
+      if not done and now - self.shown < 0.2:
+         return
+      self.shown = now
+      elapsed = max(now - self.start, 1e-9)
+      self.progress.write('\r' + "reads: " + str(self.cycles) + "  " + str(round(self.cycles / elapsed, 1)) + "/s  changed: " +
+                          str(self.lastchanged).rjust(5) + " bytes  delta file: " + str(self.written) + " bytes ")
+      self.progress.flush()
+
+   def hotspots(self, count=10):
+      # The addresses that changed in the most reads, as ( address, reads changed )
+      ranked = sorted(range(self.length), key=lambda i: -self.changes[i])[:count]
+      return [ ( self.address + i, self.changes[i] ) for i in ranked if self.changes[i] > 0 ]
+
+def readdeltas(deltafile):
+   # Yields the header, then ( seconds since start, [ ( offset, bytes ) ] ) per read of the range
+   if deltafile.read(len(deltamagic)) != deltamagic:
+      raise Exception("not an mmll delta file")
+   headersize = struct.unpack('<I', deltafile.read(4))[0]
+   yield json.loads(deltafile.read(headersize).decode())
+   while True:
+      block = deltafile.read(deltacycle.size)
+      if len(block) < deltacycle.size:
+         return
+      elapsedns, count = deltacycle.unpack(block)
+      ranges = []
+      for i in range(count):
+         offset, size = deltarange.unpack(deltafile.read(deltarange.size))
+         ranges.append(( offset, deltafile.read(size) ))
+      yield elapsedns / 1e9, ranges
+
+def connect(config, debug):
+   # Init, login and diag session as the logger does it.  Returns the Ecu.
+   ecu = pylibme7.Ecu()
+   ecu.initialize(config[0][3])
+   ecu.securityAccessL3()
+   if config[0][5].upper() == 'AUTO':
+      def reconnect():
+         ecu.initialize(config[0][3])
+         ecu.securityAccessL3()
+         ecu.startdiagsession(0)
+      ecu.startdiagsession(0)
+      bps, speeds = ecu.negotiatebaud(loglocations(config[:2])[0], reconnect=reconnect)
+   else:
+      bps = int(config[0][5])
+      ecu.startdiagsession(bps)
+   print("Connected at " + str(bps))
+   return ecu
+
+def main():
+   argparser = argparse.ArgumentParser()
+   argparser.add_argument("-c", "--configfile", help="The logging config file, for the Connect and LogSpeed settings", required=True)
+   argparser.add_argument("-a", "--address", type=lambda a: int(a, 0), help="First address to read, e.g. 0x380000", required=True)
+   argparser.add_argument("-l", "--length", type=lambda l: int(l, 0), help="Number of bytes to read, e.g. 0x10000", required=True)
+   argparser.add_argument("-o", "--outputfile", help="The binary dump file", required=True)
+   mode = argparser.add_mutually_exclusive_group()
+   mode.add_argument("--resume", action="store_true", help="Carry on from the end of an existing OUTPUTFILE")
+   mode.add_argument("-w", "--watch", action="store_true", help="Read the range over and over and write only the bytes that changed to a delta OUTPUTFILE")
+   argparser.add_argument("-n", "--cycles", type=int, default=0, help="With --watch, stop after this many reads of the range")
+   argparser.add_argument("--chunk", type=int, default=maxchunk, help="Largest read to try; the ECU may take less")
+   argparser.add_argument("-d", "--debug", type=int, choices=[0, 1, 2, 3, 4], default=0, help="Increase the Debug Level (experimental)")
+   args = argparser.parse_args()
+   pylibme7.debug = args.debug
+
+   offset = 0
+   if args.resume and os.path.exists(args.outputfile):
+      offset = os.path.getsize(args.outputfile)
+      outfile = open(args.outputfile, 'ab')
+      print("Resuming at " + hex(args.address + offset))
+   else:
+      outfile = open(args.outputfile, 'wb')
+
+   config = parseconfigfile(args.configfile)
+   ecu = connect(config, args.debug)
+   if args.watch:
+      watch = MemoryWatch(ecu, args.address, args.length, outfile, args.chunk, sys.stderr)
+      try:
+         watch.run(args.cycles)
+      except KeyboardInterrupt:
+         pass
+      outfile.close()
+      sys.stderr.write('\n' + watch.report() + '\n')
+      for address, reads in watch.hotspots():
+         print(hex(address) + "  changed in " + str(reads) + " of " + str(watch.cycles - 1) + " reads")
+      return
+
+   dump = MemoryDump(ecu, args.address, args.length, outfile, offset, args.chunk, sys.stderr)
+   try:
+      dump.run()
+   finally:
+      outfile.close()
+      if dump.offset < dump.length:
+         sys.stderr.write('\n')
+      sys.stderr.write(dump.report() + '\n')
+
+if __name__ == '__main__':
+
+   try:
+     main()
+
+   except KeyboardInterrupt:
+     print("Ctrl-c, run again with --resume to carry on")
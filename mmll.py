@@ -8,7 +8,11 @@ Copyright 2013 Ted Richardson.
 Distributed under the terms of the GNU General Public License (GPL)
 See LICENSE.txt for licensing information.
 
-usage: mmll.py [-h] -c CONFIGFILE [-o OUTPUTFILE] [-d {0,1,2,3,4}]
+usage: mmll.py [-h] -c CONFIGFILE [-o OUTPUTFILE] [-f {csv,npy,parquet}]
+               [-z {gzip,zstd,xz}] [--rotate ROTATE]
+               [--rotatetime ROTATETIME] [-d {0,1,2,3,4}] [-r] [-b BUFFER]
+               [--drop] [-s {skip,catchup,asap}] [-p] [--p3min P3MIN] [-t]
+               [--trace TRACE] [--cachedir CACHEDIR] [--nocache]
 
 optional arguments:
   -h, --help            show this help message and exit
@@ -17,8 +21,38 @@ optional arguments:
   -o OUTPUTFILE, --outputfile OUTPUTFILE
                         The desired output log file - No entry outputs log
                         data to STDOUT
+  -f {csv,npy,parquet}, --format {csv,npy,parquet}
+                        ME7Logger style CSV, or a columnar OUTPUTFILE; see
+                        columnlog.py
+  -z {gzip,zstd,xz}, --compress {gzip,zstd,xz}
+                        Compress the CSV or raw OUTPUTFILE on a background
+                        thread; see compresslog.py
+  --rotate ROTATE       With --compress, start a new file after this many MB
+  --rotatetime ROTATETIME
+                        With --compress, start a new file after this many
+                        minutes
   -d {0,1,2,3,4}, --debug {0,1,2,3,4}
                         Increase the Debug Level (experimental)
+  -r, --raw             Capture undecoded records to a binary OUTPUTFILE;
+                        convert it later with rawlog.py
+  -b BUFFER, --buffer BUFFER
+                        Poll the ECU on its own thread with a queue of BUFFER
+                        records to the output
+  --drop                With --buffer, drop records when the queue is full
+                        instead of holding up the ECU polling
+  -s {skip,catchup,asap}, --schedule {skip,catchup,asap}
+                        What to do with late samples, or log as fast as
+                        possible
+  -p, --pipeline        Request the next record as soon as the last one is
+                        in, before it is decoded
+  --p3min P3MIN         KWP2000 P3min: ms of quiet between a response and the
+                        next request, 0.5 with --pipeline and 0 otherwise
+  -t, --timing          Time each phase of the log cycle, report on exit or
+                        SIGUSR1
+  --trace TRACE         Write every byte on the bus to this binary file; print
+                        it with pylibme7.py TRACEFILE
+  --cachedir CACHEDIR   Where compiled config files are kept between runs
+  --nocache             Always parse the config files from scratch
 
 This program is free software; you can redistribute it and/or modify
 it under the terms of the GNU General Public License as published by
@@ -38,17 +72,25 @@ trichard3000
 '''
 
 from __future__ import print_function, division
-import sys, time, argparse
+import sys, os, time, argparse, struct, queue, threading, json, hashlib, signal
 import pylibme7
+import rawlog
+import columnlog
+import compresslog
 from pylibme7 import hexlist
 from me7lconfig import *
+# Only needed for block decoding.  This may need to be installed separately
+try:
+   import numpy
+except ImportError:
+   numpy = None
 
 debug = 0   # Default debug value.  Can be overridden from the command line.
 
 def printconfig(config):
    # Print out the config info
    print("Note:  Only using Connect, and Logspeed so far.")  
-   print("       Connect must only be 'SLOW-0x11' and not all baud rates are supported yet")
+   print("       Connect must be 'SLOW-0x11' or 'FAST' and not all baud rates are supported yet")
    print("       Sample Rate is ignored once max logging speed is achieved.")
    print()
    print("From Config Files:")
@@ -73,70 +115,576 @@ def textlist(tl):
    if debug >= debugneeds: print( "textlist() response: " + textresponse )
    return textresponse
  
+class LogDecoder:
+   # The log record layout from the config files, compiled once.  Offsets, struct codes,
+   # masks, signedness and the A/B factors are worked out here so a sample is decoded
+   # with a single unpack instead of re-reading every config row.
+   structcodes = { 1: 'B', 2: 'H', 4: 'I', 8: 'Q' }
+
+   def __init__(self, config):
+      self.fields = []
+      self.offsets = []
+      fmt = '<'
+      offset = 0
+      for l in range(1,len(config)):
+         size = int(config[l][3])
+         bitmask = int(config[l][4],16)
+         s = bool(int(config[l][6]))
+         i = bool(int(config[l][7]))
+         a = float(config[l][8])
+         b = float(config[l][9])
+         # Odd sizes come out of the unpack as raw bytes and are assembled little-endian
+         fmt = fmt + self.structcodes.get(size, str(size) + 's')
+         self.fields = self.fields + [ ( size not in self.structcodes, size, bitmask, s, i, a, b ) ]
+         self.offsets = self.offsets + [ offset ]
+         offset = offset + size
+      self.recordsize = offset
+      self.record = struct.Struct(fmt)
+      # Number of values decode() returns
+      self.width = len(self.fields)
+
+   def decode(self, logdata, start=None):
+      # Returns the converted values of one log record.  start is where the values begin
+      # if logdata isn't a getlogrecord() response, e.g. 2 for a readmembyaddr() one.
+      if start is None:
+         start = logdata.index( 0xF7 ) + 1
+      raw = self.record.unpack_from(bytes(logdata[ start : start + self.recordsize ]))
+      values = []
+      for internal, ( frombytes, size, bitmask, s, i, a, b ) in zip(raw, self.fields):
+         if frombytes:
+            internal = int.from_bytes(internal, 'little')
+         # bitmask code eeds tested
+         if bitmask > 0:
+            internal = internal & bitmask
+         # signed/unsigned?
+         if s:
+            internal = signed(internal,size)
+         # Inverse or regular?
+         if not i:
+            values.append(round((a * internal - b ),3))
+         else:
+            values.append(round((a / (internal - b)),3))
+      return values
+
+   def decodeblock(self, records):
+      # Converts N raw log records stacked in an (N x record length) uint8 array into an
+      # (N x variables) float array.  Values are not rounded; that's left to the output.
+      records = numpy.asarray(records, dtype=numpy.uint8)
+      start = list(records[0]).index( 0xF7 ) + 1
+      values = numpy.empty((records.shape[0], len(self.fields)))
+      for col, ( offset, ( frombytes, size, bitmask, s, i, a, b ) ) in enumerate(zip(self.offsets, self.fields)):
+         internal = numpy.zeros(records.shape[0], dtype=numpy.int64)
+         # Assemble the little-endian bytes of every record at once
+         for j in range(size):
+            internal |= records[:, start + offset + j].astype(numpy.int64) << (8 * j)
+         if bitmask > 0:
+            internal &= bitmask
+         if s:
+            conv = 2**((size * 8) - 1)
+            internal = ( internal & (conv - 1) ) - ( internal & conv )
+         if not i:
+            values[:, col] = a * internal - b
+         else:
+            with numpy.errstate(divide='ignore'):
+               values[:, col] = a / (internal - b)
+      return values
+
+   def logline(self, logdata, starttime, elapsed=None):
+      # Creates final line of logged data.  Replayed records pass their own elapsed time.
+      if elapsed is None:
+         elapsed = time.time() - starttime
+      logline = (str( round(elapsed,3) ).ljust(4,'0')).rjust(10) + ', '
+      return logline + ', '.join([ str(endval).rjust(10) for endval in self.decode(logdata) ])
+
+class MultiRateDecoder(LogDecoder):
+   # Variables with an "@N" rate below SamplesPerSecond are left out of the log record and
+   # read on their own with readmembyaddr() every 1/N seconds.  Between reads a slow
+   # variable repeats its last value, and the columns stay in config file order.
+   def __init__(self, config, fastconfig, slowrows, rates):
+      LogDecoder.__init__(self, fastconfig)
+      self.channels = []
+      for row in slowrows:
+         address = int(row[2], 16)
+         self.channels = self.channels + [ { 'name': row[0], 'decoder': LogDecoder([ config[0], row ]),
+                                             'request': [ (address >> 16) & 0xFF, (address >> 8) & 0xFF, address & 0xFF, int(row[3]) ],
+                                             'period': int(1e9 / rates[row[0]]), 'nextdue': 0, 'value': '', 'misses': 0 } ]
+      # Where each column comes from: ( True, index into the record ) or ( False, channel )
+      self.columns = []
+      fast = 0
+      slow = 0
+      for row in config[1:]:
+         if slow < len(slowrows) and row is slowrows[slow]:
+            self.columns = self.columns + [ ( False, slow ) ]
+            slow = slow + 1
+         else:
+            self.columns = self.columns + [ ( True, fast ) ]
+            fast = fast + 1
+      self.width = len(self.columns)
+
+   def poll(self, ecu, limit=1):
+      # Reads slow variables that are due, at most limit of them so a pile of them coming
+      # due together doesn't hold up the log record.  Call it between log records.
+      now = time.monotonic_ns()
+      for channel in self.channels:
+         if limit <= 0:
+            break
+         if now < channel['nextdue']:
+            continue
+         limit = limit - 1
+         channel['nextdue'] = channel['nextdue'] + channel['period']
+         if channel['nextdue'] <= now:
+            channel['nextdue'] = now + channel['period']
+         try:
+            response = ecu.readmembyaddr(channel['request'])
+            channel['value'] = channel['decoder'].decode(response, 2)[0]
+         except pylibme7.EcuTimeout:
+            ecu.clearrecv()
+            channel['misses'] = channel['misses'] + 1
+         except Exception as e:
+            # A negative response; keep the old value and try again next period
+            if debug >= 1:  print("readmembyaddr() for " + channel['name'] + ": " + str(e.args[0]))
+            channel['misses'] = channel['misses'] + 1
+
+   def decode(self, logdata, start=None):
+      fast = LogDecoder.decode(self, logdata, start)
+      return [ fast[i] if infast else self.channels[i]['value'] for infast, i in self.columns ]
+
 def parselogdata(config, logdata, starttime):
    # Takes the raw logged values and applies the conversions from the ECU config file.
-   logline = (str( round((time.time() - starttime),3) ).ljust(4,'0')).rjust(10) + ', '
-   counter = logdata.index( 0xF7 ) + 1
-   for l in range(1,len(config)):
-      size = int(config[l][3])
-      bitmask = int(config[l][4],16)
-      s = bool(int(config[l][6]))
-      i = bool(int(config[l][7]))
-      a = float(config[l][8])
-      b = float(config[l][9])
-      
-      bytes = logdata[ counter : counter + size ]
-      byteconv = ""
-      # Read bytes in reverse order.
-      for j in range(len(bytes)):
-         byteconv = hex(bytes[j])[2:].rjust(2,'0') + byteconv 
-         internal = int('0x'+byteconv, 16)
-      
-      # bitmask code eeds tested
-      if bitmask > 0:
-         internal = internal & bitmask
-
-      # signed/unsigned?
-      if s == True:
-         internal = signed(internal,size)
-
-      # Inverse or regular?
-      if i == False:
-         endval = round((a * internal - b ),3)
-      else:
-         endval = round((a / (internal - b)),3)
+   # The logging loop keeps one LogDecoder around instead of compiling it every sample.
+   return LogDecoder(config).logline(logdata, starttime)
 
-      # Creates final line of logged data
-      logline = logline + str(endval).rjust(10)
-      if l < len(config)-1:
-         logline = logline + ', '
-
-      counter = counter + size
-   return logline
+def parselogblock(config, records):
+   # Batch version of parselogdata() for offline work on captured records.  Needs numpy.
+   if numpy is None:
+      raise Exception("parselogblock() requires numpy")
+   return LogDecoder(config).decodeblock(records)
 
 def signed(n,bytecount):
       # Conversion for signed values
       conv = 2**((bytecount * 8) - 1)
       return ( n & (conv - 1 ) ) - ( n & conv ) 
 
+def pollrecord(ecu, debug, step=None):
+   # Requests one log record.  Returns None if it went missing on the bus.
+   # step picks one half of the request for pipelined logging.
+   try:
+      if step is None:
+         response = ecu.getlogrecord()
+      elif step == 'request':
+         return ecu.requestlogrecord()
+      else:
+         response = ecu.readlogrecord()
+   except pylibme7.EcuTimeout as e:
+      # Drop whatever is left of the record so the next one starts clean.
+      if debug >= 1:  print("getlogrecord() timed out: " + str(e.args[1]) + " bytes expected")
+      ecu.clearrecv()
+      return None
+   if debug >= 3:  print("getrecord(): request: [ 0xb7 ] response: " + hexlist(response))
+   return response
+
+class RecordCycle:
+   # Stands in for the Ecu when a planreads() plan takes more than one log record read: the
+   # variables don't fit in one layout, or some of them come cheaper as readmembyaddr()
+   # blocks.  The ECU holds one layout at a time, so with several every line is a round of
+   # setuplogrecord() and read for each layout.  The pieces are sliced into one record in
+   # config order, as if the ECU had sent it whole.  Anything else goes straight to the Ecu.
+   def __init__(self, ecu, plan):
+      self.ecu = ecu
+      self.layouts = plan['layouts']
+      self.blocks = [ [ (address >> 16) & 0xFF, (address >> 8) & 0xFF, address & 0xFF, span ] for address, span in plan['blocks'] ]
+      self.slices = plan['slices']
+      self.cycles = 0
+
+   def __getattr__(self, name):
+      return getattr(self.ecu, name)
+
+   def setup(self, layout):
+      for retry in range(3):
+         try:
+            return self.ecu.setuplogrecord(self.layouts[layout])
+         except Exception as e:
+            if e.args[0] != "busyRepeatRequest":
+               raise e
+      return self.ecu.setuplogrecord(self.layouts[layout])
+
+   def requestlogrecord(self):
+      if not self.layouts:
+         return None
+      if len(self.layouts) > 1:
+         self.setup(0)
+      return self.ecu.requestlogrecord()
+
+   def readlogrecord(self):
+      pieces = []
+      if self.layouts:
+         pieces.append(self.ecu.readlogrecord())
+      for layout in range(1, len(self.layouts)):
+         self.setup(layout)
+         pieces.append(self.ecu.getlogrecord())
+      for block in self.blocks:
+         pieces.append(self.ecu.readmembyaddr(block))
+      # A 0x00 length byte: the joined record can be longer than a frame, and decode()
+      # looks for the first 0xF7.  Every piece has its length byte and service byte first.
+      record = [ 0x00, 0xF7 ]
+      for piece, start, end in self.slices:
+         record = record + pieces[piece][2 + start : 2 + end]
+      self.cycles = self.cycles + 1
+      return record
+
+   def getlogrecord(self):
+      self.requestlogrecord()
+      return self.readlogrecord()
+
+class SampleClock:
+   # Paces samples on a fixed grid of absolute time.monotonic_ns() deadlines, so overruns
+   # and wall clock changes don't turn into drift.  When a sample is late by a whole period
+   # or more, 'skip' moves on to the next slot in the future and 'catchup' takes the missed
+   # slots back to back.  'asap' (or 0 samples/second) doesn't wait at all.
+   def __init__(self, samplespersecond, policy='skip'):
+      self.policy = policy
+      if policy == 'asap' or samplespersecond <= 0:
+         self.period = 0
+      else:
+         self.period = 1000000000 // samplespersecond
+      self.start = time.monotonic_ns()
+      self.deadline = self.start
+      self.samples = 0
+      self.skipped = 0
+      self.latesamples = 0
+      self.totallate = 0
+      self.maxlate = 0
+
+   def due(self):
+      return time.monotonic_ns() >= self.deadline
+
+   def wait(self):
+      # Waits for the next slot and returns how late the sample is in ns
+      now = time.monotonic_ns()
+      if now < self.deadline:
+         time.sleep((self.deadline - now) / 1e9)
+         now = time.monotonic_ns()
+      late = now - self.deadline
+      self.samples = self.samples + 1
+      if self.period == 0:
+         self.deadline = now
+         return 0
+      if late > self.period // 10:
+         self.latesamples = self.latesamples + 1
+      self.totallate = self.totallate + late
+      self.maxlate = max(self.maxlate, late)
+      self.deadline = self.deadline + self.period
+      if self.policy == 'skip' and now >= self.deadline:
+         missed = (now - self.deadline) // self.period + 1
+         self.skipped = self.skipped + missed
+         self.deadline = self.deadline + missed * self.period
+      return late
+
+   def rate(self):
+      # Achieved samples per second so far
+      elapsed = time.monotonic_ns() - self.start
+      if elapsed <= 0:
+         return 0.0
+      return self.samples * 1e9 / elapsed
+
+   def report(self):
+      report = "Samples: " + str(self.samples) + "  achieved rate: " + str(round(self.rate(), 2)) + "/s"
+      if self.period > 0 and self.samples > 0:
+         report = report + "  late: " + str(self.latesamples) + "  skipped: " + str(self.skipped)
+         report = report + "  mean lateness: " + str(round(self.totallate / self.samples / 1e6, 3)) + " ms"
+         report = report + "  max lateness: " + str(round(self.maxlate / 1e6, 3)) + " ms"
+      return report
+
+def polllog(ecu, deliver, clock, pipelined, debug, stop=None, slowpoll=None):
+   # Requests log records on the clock's schedule and hands each one to
+   # deliver(response, readns) until stop is set.  slowpoll(ecu), if given, runs
+   # between records while the bus is idle.
+   if not pipelined:
+      while stop is None or not stop.is_set():
+         clock.wait()
+         response = pollrecord(ecu, debug)
+         if response is not None:
+            deliver(response, time.perf_counter_ns())
+         if slowpoll is not None:
+            slowpoll(ecu)
+      return
+
+   # Pipelined: once a response is in, the next request goes on the wire as soon as P3min allows
+   # (if it's due) so the ECU assembles the next record while this one is decoded and
+   # written.  A missed record simply isn't delivered; the next request still goes out.
+   clock.wait()
+   pollrecord(ecu, debug, 'request')
+   while stop is None or not stop.is_set():
+      response = pollrecord(ecu, debug, 'read')
+      readns = time.perf_counter_ns()
+      if slowpoll is not None:
+         # The only gap with nothing in flight
+         slowpoll(ecu)
+      requested = False
+      if clock.due():
+         clock.wait()
+         pollrecord(ecu, debug, 'request')
+         requested = True
+      if response is not None:
+         deliver(response, readns)
+      if not requested:
+         clock.wait()
+         pollrecord(ecu, debug, 'request')
+
+class CsvEmitter:
+   # Collects decoded rows and writes them out in blocks, formatted all at once with a template
+   # made up front for the logcolumns() layout.  '{:>10}' prints a value exactly the way
+   # str().rjust(10) in LogDecoder.logline() does, so the lines are the same byte for byte.
+   # Rows go out once flushsize bytes' worth are waiting or flushtime seconds have passed.
+   def __init__(self, outfile, columns, flushsize=65536, flushtime=1.0):
+      self.outfile = outfile
+      self.template = ', '.join([ '{:>10}' ] * columns) + '\n'
+      # Every value takes 10 characters and a separator
+      self.flushrows = max(1, flushsize // (12 * (columns + 1)))
+      self.flushtime = flushtime
+      self.rows = []
+      self.lastflush = time.monotonic()
+      self.written = 0
+
+   def add(self, elapsed, values):
+      self.rows.append(( elapsed, values ))
+      if len(self.rows) >= self.flushrows or time.monotonic() - self.lastflush >= self.flushtime:
+         self.flush()
+
+   def format(self, rows):
+      template = self.template.format
+      return ''.join([ (str( round(elapsed,3) ).ljust(4,'0')).rjust(10) + ', ' + template(*values) for elapsed, values in rows ])
+
+   def flush(self):
+      if self.rows:
+         rows = self.rows
+         self.rows = []
+         self.outfile.write(self.format(rows))
+         self.written = self.written + len(rows)
+      self.outfile.flush()
+      self.lastflush = time.monotonic()
+
+   def close(self):
+      self.flush()
+
+class LogOutput:
+   # Everything that happens to a record once it's off the bus: decode and write, or raw capture.
+   # flushtime 0 writes every line as it comes, for watching the log on the terminal.
+   # emitter replaces the CSV output, e.g. with a columnlog one.
+   def __init__(self, outfile, decoder, rawout, spin, phases=None, flushtime=1.0, emitter=None):
+      self.phases = phases
+      self.outfile = outfile
+      self.decoder = decoder
+      self.rawout = rawout
+      self.emitter = emitter
+      if rawout is None and emitter is None:
+         self.emitter = CsvEmitter(outfile, decoder.width, flushtime=flushtime)
+      self.spin = spin
+      self.spinner = 0
+      self.spinstr = [ '|', '/', '-', '\\' ]
+      self.spun = 0.0
+      self.startns = time.perf_counter_ns()
+
+   def write(self, response, readns):
+      # readns is the perf_counter_ns() reading taken when the record was received
+      if self.phases is not None:
+         start = time.perf_counter_ns()
+      if self.rawout is not None:
+         # Decoding waits for rawlog.py
+         self.rawout.write(response, readns - self.startns)
+      else:
+         # Pipe log output to parser, based on info pulled from the config and ecu files
+         values = self.decoder.decode(response)
+         if self.phases is not None:
+            decoded = time.perf_counter_ns()
+            self.phases.add("decode", decoded - start)
+            start = decoded
+         self.emitter.add((readns - self.startns) / 1e9, values)
+      if self.phases is not None:
+         self.phases.add("output write", time.perf_counter_ns() - start)
+
+      # Just for fun, a few turns a second
+      if self.spin:
+         now = time.monotonic()
+         if now - self.spun >= 0.1:
+            self.spun = now
+            sys.stdout.write('\b' + self.spinstr[self.spinner])
+            sys.stdout.flush()
+            self.spinner = (self.spinner + 1) % 4
+
+   def flush(self):
+      if self.emitter is not None:
+         self.emitter.flush()
+      elif self.rawout is not None:
+         self.rawout.flush()
+
+   def close(self):
+      # The last rows, and for Parquet the file footer
+      if self.emitter is not None:
+         self.emitter.close()
+      else:
+         self.flush()
+
+class RecordQueue:
+   # Bounded hand-off from the ECU polling thread to the output thread.  When it's full
+   # the poller either waits for room (backpressure) or drops the record and counts it.
+   def __init__(self, size, drop):
+      self.queue = queue.Queue(size)
+      self.drop = drop
+      self.dropped = 0
+      self.highwater = 0
+      self.stop = threading.Event()
+
+   def put(self, item):
+      if self.drop:
+         try:
+            self.queue.put_nowait(item)
+         except queue.Full:
+            self.dropped = self.dropped + 1
+      else:
+         while not self.stop.is_set():
+            try:
+               self.queue.put(item, timeout=0.1)
+               break
+            except queue.Full:
+               pass
+      self.highwater = max(self.highwater, self.queue.qsize())
+
+   def get(self):
+      # Returns the next record, or None once stopped and drained
+      while True:
+         try:
+            return self.queue.get(timeout=0.1)
+         except queue.Empty:
+            if self.stop.is_set():
+               return None
+
+def threadedlog(ecu, output, records, clock, pipelined, debug, slowpoll=None):
+   # Polls the ECU on one thread and decodes/writes on another so slow output
+   # doesn't stall the request cadence.  Runs until ctrl-c or a thread fails.
+   errors = []
+
+   def poller():
+      try:
+         polllog(ecu, lambda response, readns: records.put(( response, readns )), clock, pipelined, debug, records.stop, slowpoll)
+      except Exception as e:
+         errors.append(e)
+      records.stop.set()
+
+   def writer():
+      try:
+         while True:
+            item = records.get()
+            if item is None:
+               break
+            output.write(*item)
+      except Exception as e:
+         errors.append(e)
+      records.stop.set()
+
+   threads = [ threading.Thread(target=poller, name="mmll-poll"), threading.Thread(target=writer, name="mmll-write") ]
+   for t in threads:
+      t.start()
+   try:
+      while not records.stop.is_set():
+         records.stop.wait(0.5)
+   finally:
+      records.stop.set()
+      for t in threads:
+         t.join()
+      if debug >= 1 or records.dropped > 0:
+         sys.stdout.write('\r' + "Queue high water: " + str(records.highwater) + "  dropped records: " + str(records.dropped) + '\n')
+   if errors:
+      raise errors[0]
+
+# The hardware number alone is shared across units and survives a reflash, so the
+# fingerprint adds 0x9b, which carries the part number and software version
+fingerprintids = [ 0x91, 0x9b ]
+ecuidlist = [ 0x87, 0x9c ]
+
+def ecuidfile(cachedir, fingerprint):
+   # The ID cache file for the ECU that answered with this fingerprint
+   return os.path.join(cachedir, 'ecuid-' + hashlib.sha256(json.dumps(fingerprint).encode()).hexdigest()[:16] + '.json')
+
+def loadecuids(cachedir, fingerprint):
+   # Returns the cached ECU IDs for this fingerprint, or None
+   try:
+      cached = open(ecuidfile(cachedir, fingerprint))
+      ecuids = json.load(cached)
+      cached.close()
+      return dict([ ( int(k), v ) for k, v in ecuids.items() ])
+   except (OSError, ValueError):
+      return None
+
+def saveecuids(cachedir, fingerprint, ecuids):
+   try:
+      os.makedirs(cachedir, exist_ok=True)
+      cachefile = ecuidfile(cachedir, fingerprint)
+      cached = open(cachefile + '.' + str(os.getpid()), 'w')
+      json.dump(ecuids, cached)
+      cached.close()
+      os.replace(cachefile + '.' + str(os.getpid()), cachefile)
+   except OSError:
+      pass
+
 def main(debug):
    # The main routine
 
    argparser = argparse.ArgumentParser()
    argparser.add_argument("-c", "--configfile", help="The logging config file", required=True)
    argparser.add_argument("-o", "--outputfile", help="The desired output log file - No entry outputs log data to STDOUT")
+   argparser.add_argument("-f", "--format", choices=columnlog.formats, default='csv', help="ME7Logger style CSV, or a columnar OUTPUTFILE; see columnlog.py")
+   argparser.add_argument("-z", "--compress", choices=compresslog.methods, help="Compress the CSV or raw OUTPUTFILE on a background thread; see compresslog.py")
+   argparser.add_argument("--rotate", type=float, default=0, help="With --compress, start a new file after this many MB")
+   argparser.add_argument("--rotatetime", type=float, default=0, help="With --compress, start a new file after this many minutes")
    argparser.add_argument("-d", "--debug", type=int, choices=[0, 1, 2, 3, 4], default=debug, help="Increase the Debug Level (experimental)")
+   argparser.add_argument("-r", "--raw", action="store_true", help="Capture undecoded records to a binary OUTPUTFILE; convert it later with rawlog.py")
+   argparser.add_argument("-b", "--buffer", type=int, default=0, help="Poll the ECU on its own thread with a queue of BUFFER records to the output")
+   argparser.add_argument("--drop", action="store_true", help="With --buffer, drop records when the queue is full instead of holding up the ECU polling")
+   argparser.add_argument("-s", "--schedule", choices=['skip', 'catchup', 'asap'], default='skip', help="What to do with late samples, or log as fast as possible")
+   argparser.add_argument("-p", "--pipeline", action="store_true", help="Request the next record as soon as the last one is in, before it is decoded")
+   argparser.add_argument("--p3min", type=float, help="KWP2000 P3min: ms of quiet between a response and the next request, 0.5 with --pipeline and 0 otherwise")
+   argparser.add_argument("-t", "--timing", action="store_true", help="Time each phase of the log cycle, report on exit or SIGUSR1")
+   argparser.add_argument("--trace", help="Write every byte on the bus to this binary file; print it with pylibme7.py TRACEFILE")
+   argparser.add_argument("--cachedir", default=defaultcachedir(), help="Where compiled config files are kept between runs")
+   argparser.add_argument("--nocache", action="store_true", help="Always parse the config files from scratch")
    args = argparser.parse_args()
-
+   if args.raw and args.outputfile is None:
+      argparser.error("--raw needs an OUTPUTFILE")
+   if args.format != 'csv' and args.outputfile is None:
+      argparser.error("--format " + args.format + " needs an OUTPUTFILE")
+   if args.format != 'csv' and args.raw:
+      argparser.error("--raw captures are converted with rawlog.py, which takes --format too")
+   if args.compress is not None and (args.outputfile is None or args.format != 'csv'):
+      argparser.error("--compress needs a CSV or raw OUTPUTFILE")
+   if args.p3min is not None and args.p3min < 0:
+      argparser.error("--p3min can't be negative")
+   clock = None
+   output = None
+   logecu = None
+   phases = None
+   tracefile = None
+   outfile = None
+   rawout = None
 
    try:
       # Use config data from the command line
-      config = parseconfigfile(str(args.configfile))
-      if str(args.outputfile) != "None":
+      if args.nocache:
+         compiled = compileconfig(str(args.configfile))
+      else:
+         compiled = compileconfig(str(args.configfile), args.cachedir)
+      config = compiled['config']
+      if args.compress is not None:
+         outfile = compresslog.CompressedFile(str(args.outputfile), args.compress,
+                                              rotatesize=int(args.rotate * 1e6), rotatetime=args.rotatetime * 60)
+      elif args.raw or args.format != 'csv':
+         outfile = open(str(args.outputfile), 'wb')
+      elif str(args.outputfile) != "None":
          outfile = open(str(args.outputfile), 'w')
       else:
          outfile = sys.stdout
       debug = args.debug
+      pylibme7.debug = debug
 
       # Print Config data
       print()
@@ -146,13 +694,41 @@ def main(debug):
 
 
       ecu = pylibme7.Ecu()
+      # A pipelined request would otherwise go out right on the heels of the checksum byte.
+      # 0.5 ms is the finest step the P3min timing parameter has.
+      if args.p3min is not None:
+         ecu.p3min = args.p3min / 1000
+      elif args.pipeline:
+         ecu.p3min = 0.0005
+      if args.trace is not None:
+         tracefile = open(args.trace, 'wb')
+         ecu.trace = pylibme7.BusTrace(tracefile)
+      if args.timing:
+         # Per-phase timings, dumped at the end or on kill -USR1
+         phases = pylibme7.PhaseTimer()
+         ecu.phases = phases
+         if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: sys.stderr.write(phases.report() + '\n'))
       ecu.initialize(config[0][3])
       print(config)
 
       print("....sealed")
 
       # print("Connected at 14400")
-      ecu.readecuid([0x91])
+      # The fingerprint IDs are cheap and tell us if we've seen this ECU before.  The
+      # rest are only read for a new ECU, all in this one diag session.
+      ecuids = ecu.readecuids(fingerprintids)
+      fingerprint = [ ecuids[i] for i in fingerprintids ]
+      cached = None
+      if not args.nocache and None not in fingerprint:
+         cached = loadecuids(args.cachedir, fingerprint)
+      if cached is None:
+         ecuids.update(ecu.readecuids(ecuidlist, session=False))
+         if not args.nocache and None not in fingerprint:
+            saveecuids(args.cachedir, fingerprint, ecuids)
+      else:
+         ecuids = cached
+         print("ECU identification from cache")
       # swnumber = textlist(response)
       swnumber = ""
 
@@ -160,40 +736,30 @@ def main(debug):
       response = ecu.securityAccessL3()
       # response = ecu.securityAccessL1()
  
-      response = ecu.startdiagsession(int(config[0][5]))
+      # LogSpeed = AUTO stays at the init baud until the log record is known, then
+      # negotiatebaud() picks the fastest rate that works
+      autospeed = config[0][5].upper() == 'AUTO'
+      if autospeed:
+         response = ecu.startdiagsession(0)
+      else:
+         response = ecu.startdiagsession(int(config[0][5]))
       # TODO: validate positive response
       if debug >= 3:  print("startdiagsession(" + config[0][5] +") response: " + hexlist(response) )
       print("Connected at " + config[0][5] )
 
-      try:
-         response = ecu.readecuid([0x87])
-         hardwareNumber = textlist(response)
-         print(f"VW Diagnosesoftwarenummer: {hardwareNumber}")
-      except:
-         pass
-      try:
-         response = ecu.readecuid([0x91])
-         hardwareNumber = textlist(response)
-         print(f"VW hardwareNumber: {hardwareNumber}")
-      except:
-         pass
-      try:
-         response = ecu.readecuid([0x9b])
-         vwecuID = textlist(response)
-         print(f"VW ECU ID: {vwecuID}")
-      except:
-         pass
-      try:
-         response = ecu.readecuid([0x9c])
-         flashInfo = textlist(response)
-         print(f"FlashInfo: str:{flashInfo} hex:{hexlist(response)}")
-      except:
-         pass
+      if ecuids.get(0x87) is not None:
+         print(f"VW Diagnosesoftwarenummer: {textlist(ecuids[0x87])}")
+      if ecuids.get(0x91) is not None:
+         print(f"VW hardwareNumber: {textlist(ecuids[0x91])}")
+      if ecuids.get(0x9b) is not None:
+         print(f"VW ECU ID: {textlist(ecuids[0x9b])}")
+      if ecuids.get(0x9c) is not None:
+         print(f"FlashInfo: str:{textlist(ecuids[0x9c])} hex:{hexlist(ecuids[0x9c])}")
 
 
       p2min = [ 0 ]
       p2max = [ 1 ]
-      p3min = [ 0 ]
+      p3min = [ int(round(ecu.p3min * 2000)) ]    # 0.5 ms steps
       p3max = [ 20 ]
       p4min = [ 0 ]
       p4max = [ 20 ]
@@ -224,8 +790,8 @@ def main(debug):
       config[0] = config [0] + [ modelid ]
 
       #I don't know how this is used.
-      ecuid_0x9c = ecu.readecuid([ 0x9c ])
-      if debug >= 3:  print("exuid_0x9c =" + hexlist(ecuid_0x9c) )
+      ecuid_0x9c = ecuids.get(0x9c)
+      if debug >= 3 and ecuid_0x9c is not None:  print("exuid_0x9c =" + hexlist(ecuid_0x9c) )
 
       # Check ECU values versus config file
       cfgcheck = True
@@ -278,22 +844,71 @@ def main(debug):
          ecu.recv(1)   
 
          # Tell ECU memory locations to log, based on the config and ecu file data:
-         logline = loglocations(config)
-         def setuplogrecord():
-            return ecu.setuplogrecord(logline[0])
-         success = False
+         logline = compiled['locations']
+         # Slower "@N" variables are read on their own unless everything goes to a raw capture
+         fastconfig, slowrows = splitrates(config, compiled['rates'])
+         if slowrows and args.raw:
+            print("Note: raw captures log every variable in every record, @ rates are ignored")
+            slowrows = []
+         if slowrows:
+            if len(fastconfig) == 1:
+               raise Exception("at least one variable has to be logged at the SamplesPerSecond rate")
+            for row in slowrows:
+               print("Slow channel : " + row[0] + " @ " + str(compiled['rates'][row[0]]) + "/s")
+            logline = loglocations(fastconfig)
+         # How the variables are read: log record layouts, and block reads where cheaper
+         if slowrows:
+            plan = planreads(fastconfig)
+         else:
+            plan = compiled['plan']
+         layouts = plan['layouts']
+         if len(layouts) > 1:
+            print("Logging " + str(len(layouts)) + " record layouts in turn, each row takes " + str(len(layouts) * 2) + " requests")
+         for address, span in plan['blocks']:
+            print("Block read   : " + hex(address) + " " + str(span) + " bytes")
+         if not layouts and not plan['blocks']:
+            # No variables at all: the empty log record setup, as always
+            layouts = [ [] ]
+         if autospeed:
+            # The baud rate is tried out with the first layout, or with the first variable
+            # when everything is read in blocks
+            if layouts:
+               probeline = layouts[0]
+            else:
+               probeline = loglocations([ config[0], config[1] ])[0]
+            def reconnect():
+               ecu.initialize(config[0][3])
+               ecu.securityAccessL3()
+               ecu.startdiagsession(0)
+            bps, speeds = ecu.negotiatebaud(probeline, reconnect=reconnect)
+            config[0][5] = str(bps)
+            print("Negotiated LogSpeed: " + config[0][5] )
+
+         success = not layouts
          while(not success):
             try:
-               response = ecu.setuplogrecord(logline[0])
+               response = ecu.setuplogrecord(layouts[0])
                success = True
             except Exception as e:
                if e.args[0] != "busyRepeatRequest":
                   raise e
                print("retrying....");
                
-         if debug >= 3:  print("loglocations(): request: " + hexlist(logline[0]) + " response: " + hexlist(response) )
+         if debug >= 3 and layouts:  print("loglocations(): request: " + hexlist(layouts[0]) + " response: " + hexlist(response) )
          # grab logpacketsize from loglocations() return and tack it to the end of ecu config info
          config[0] = config[0] + [ logline[1] ]
+         slowpoll = None
+         if slowrows:
+            decoder = MultiRateDecoder(config, fastconfig, slowrows, compiled['rates'])
+            # Every slow channel gets a value before the first line is written
+            decoder.poll(ecu, len(slowrows))
+            slowpoll = decoder.poll
+         else:
+            decoder = LogDecoder(config)
+
+         logecu = ecu
+         if len(layouts) > 1 or plan['blocks']:
+            logecu = RecordCycle(ecu, plan)
 
          print(".....delivered")
          if str(args.outputfile) != 'None':
@@ -302,40 +917,29 @@ def main(debug):
 
          # Finally, start logging records!
 
-         headers = logheader(config)
-         for line in headers:
-            outfile.write(line + '\n')
+         emitter = None
+         if args.raw:
+            rawout = rawlog.RawWriter(outfile, config, logline[0])
+         elif args.format != 'csv':
+            emitter = columnlog.openemitter(args.format, outfile, config)
+         else:
+            headers = logheader(config, columns=compiled['columns'])
+            for line in headers:
+               outfile.write(line + '\n')
+         if args.compress is not None:
+            # Every rotated file starts with the log or capture header
+            outfile.keepheader()
 
          secondstolog = 10
-         starttime = time.time()
+         clock = SampleClock(int(config[0][1]), args.schedule)
+         output = LogOutput(outfile, decoder, rawout, str(args.outputfile) != 'None', phases,
+                            0 if outfile is sys.stdout else 1.0, emitter)
 
-         spinner = 0
-         spinstr = [ '|', '/', '-', '\\' ]
-
-         while True:
-            timerstart = time.time()
-            response = ecu.getlogrecord()
-            if debug >= 3:  print("getrecord(): request: [ 0xb7 ] response: " + hexlist(response))
-
-            # Pipe log output to parser, based on info pulled from the config and ecu files
-            response = parselogdata(config, response, starttime)
-            outfile.write( response + '\n') 
-
-
-            # Just for fun
-            if str(args.outputfile) != 'None':
-               spinout = spinstr[spinner]
-               sys.stdout.write('\b' + spinout)
-               sys.stdout.flush()
-               spinner = spinner + 1
-               if spinner == 4: spinner = 0
-
-            # Sleep to adjust log records per second
-            samplerate = 1/int(config[0][1])
-            timerfinish = time.time()
-            adjust = (timerfinish-timerstart)
-            if adjust < samplerate:
-               time.sleep((samplerate)-(timerfinish-timerstart))
+         if args.buffer > 0:
+            records = RecordQueue(args.buffer, args.drop)
+            threadedlog(logecu, output, records, clock, args.pipeline, debug, slowpoll)
+         else:
+            polllog(logecu, output.write, clock, args.pipeline, debug, None, slowpoll)
 
       else:
          print("Config check failed")
@@ -344,12 +948,30 @@ def main(debug):
    except KeyboardInterrupt:
       sys.stdout.write('\r' + "Stopping".ljust(30) + '\n')
 
-   sys.stdout.write('\r')
-   sys.stdout.flush()
-   
-   # Wrap things up.
-   outfile.flush()
-   print("Logging Finished")
+   # Wrap things up, errors included, so buffered rows, file footers and the last
+   # compressed chunk still make it to disk.
+   finally:
+      sys.stdout.write('\r')
+      sys.stdout.flush()
+      if output is not None:
+         output.close()
+      if outfile is not None:
+         outfile.flush()
+      if isinstance(outfile, compresslog.CompressedFile):
+         outfile.close()
+         print(outfile.report())
+      if tracefile is not None:
+         tracefile.close()
+      if rawout is not None and (debug >= 1 or rawout.dropped > 0):
+         print("Raw capture dropped records (wrong length): " + str(rawout.dropped))
+      if clock is not None:
+         print(clock.report())
+      if isinstance(logecu, RecordCycle) and clock is not None:
+         print("Record layouts: " + str(len(logecu.layouts)) + "  block reads: " + str(len(logecu.blocks)) + "  full rows: " + str(logecu.cycles) +
+               "  per-variable rate: " + str(round(logecu.cycles * 1e9 / (time.monotonic_ns() - clock.start), 2)) + "/s")
+      if phases is not None:
+         sys.stderr.write(phases.report() + '\n')
+      print("Logging Finished")
 
 
    
@@ -0,0 +1,237 @@
+#!/usr/bin/python
+
+'''
+mmllbench.py
+- throughput benchmark for the mmll.py logging loop against a simulated ECU
+
+usage: mmllbench.py [-h] [-n RECORDS] [-v VARIABLES] [--baud BAUD]
+                    [--rate RATE] [--nodelay]
+                    [--suite | -p | -b BUFFER | --fastinit]
+                    [--min-rate MIN_RATE]
+
+Runs the same polllog()/LogOutput path mmll.py uses, with a simecu.SimEcu in
+place of the cable and the car, and reports records/sec, request to response
+latency percentiles and CPU time per record.  The CPU figure includes the
+simulator, which is a small part of it.  With --min-rate the exit status is 1
+when any run falls short, so it can guard against regressions.
+
+--fastinit checks the FAST connect instead: the wake-up pattern timings, a
+retry after a dropped and after a rejected StartCommunication, and the address
+taken from FAST-0xNN.  The exit status is 1 when a check fails.
+
+Copyright 2013 Ted Richardson.
+Distributed under the terms of the GNU General Public License (GPL)
+See LICENSE.txt for licensing information.
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program; if not, write to the Free Software Foundation, Inc.,
+51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+--
+trichard3000
+'''
+
+import sys, os, time, argparse, contextlib
+from collections import deque
+import pylibme7
+import simecu
+import mmll
+from me7lconfig import loglocations
+
+def benchconfig(variables, samples):
+   # A made up config: alternating byte and word variables from 0x380C00 up
+   config = [ [ 'bench.ecu', str(samples), '', 'FAST', 'HM0', '', '', '', '', '', '', '' ] ]
+   address = 0x380C00
+   for i in range(variables):
+      size = 1 + i % 2
+      config = config + [ [ 'var' + str(i), 'Var' + str(i), '0x' + hex(address)[2:].upper(), str(size),
+                            '0000', '{-}', str(int(i % 3 == 0)), '0', '0.75', '0', '' ] ]
+      address = address + size
+   return config
+
+def percentile(values, pct):
+   if not values:
+      return 0.0
+   ordered = sorted(values)
+   return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+class BenchOutput:
+   # Passes records on to the real LogOutput and stops the run after enough of them
+   def __init__(self, output, records, stop):
+      self.output = output
+      self.records = records
+      self.stop = stop
+      self.delivered = 0
+
+   def write(self, response, readns):
+      self.output.write(response, readns)
+      self.delivered = self.delivered + 1
+      if self.delivered >= self.records:
+         self.stop.set()
+
+def benchrun(records, variables, baud, rate, bytedelay, pipelined, buffer):
+   # Connects to a fresh simulated ECU and logs the given number of records.
+   # Returns a dict of results.
+   sim = simecu.SimEcu(bytedelay=bytedelay)
+   for i in range(0, 0x10000, 7):
+      sim.memory[i] = i & 0xFF
+   ecu = pylibme7.Ecu(ser=sim, bitbang=sim.bitbangdevice)
+   if pipelined:
+      # The same P3min mmll.py keeps with --pipeline
+      ecu.p3min = 0.0005
+   config = benchconfig(variables, rate)
+   locations = loglocations(config)
+   config[0] = config[0] + [ locations[1] ]
+
+   # Time every request to the end of its response
+   sent = deque()
+   latencies = []
+   request = ecu.requestlogrecord
+   read = ecu.readlogrecord
+   def timedrequest():
+      sent.append(time.perf_counter_ns())
+      return request()
+   def timedread():
+      start = sent.popleft()
+      response = read()
+      latencies.append(time.perf_counter_ns() - start)
+      return response
+   ecu.requestlogrecord = timedrequest
+   ecu.readlogrecord = timedread
+
+   devnull = open(os.devnull, 'w')
+   with contextlib.redirect_stdout(devnull):
+      ecu.initialize('FAST')
+      ecu.startdiagsession(baud)
+      ecu.setuplogrecord(locations[0])
+
+      queued = mmll.RecordQueue(max(buffer, 1), False)
+      output = BenchOutput(mmll.LogOutput(devnull, mmll.LogDecoder(config), None, False), records, queued.stop)
+      clock = mmll.SampleClock(rate)
+
+      cpustart = time.process_time()
+      wallstart = time.perf_counter()
+      if buffer > 0:
+         mmll.threadedlog(ecu, output, queued, clock, pipelined, 0)
+      else:
+         mmll.polllog(ecu, output.write, clock, pipelined, 0, output.stop)
+      elapsed = time.perf_counter() - wallstart
+      cpu = time.process_time() - cpustart
+   devnull.close()
+
+   return { 'records': output.delivered, 'elapsed': elapsed, 'rate': output.delivered / elapsed,
+            'p50': percentile(latencies, 50) / 1e6, 'p95': percentile(latencies, 95) / 1e6,
+            'p99': percentile(latencies, 99) / 1e6, 'max': percentile(latencies, 100) / 1e6,
+            'cpu': cpu / max(output.delivered, 1) * 1e6, 'writes': ecu.lastwrites }
+
+def report(name, result):
+   print(name.ljust(22) + str(result['records']).rjust(7) + str(round(result['rate'], 1)).rjust(10) +
+         str(round(result['p50'], 3)).rjust(9) + str(round(result['p95'], 3)).rjust(9) +
+         str(round(result['p99'], 3)).rjust(9) + str(round(result['max'], 3)).rjust(9) +
+         str(round(result['cpu'], 1)).rjust(10) + str(result['writes']).rjust(7))
+
+def fastinitrun(connect, address=0x01, failure=False):
+   # Connects to a fresh simulated ECU with the given Connect setting.  failure is a
+   # StartCommunication negative response code for the first attempt, None drops the reply.
+   sim = simecu.SimEcu(address=address)
+   if failure is not False:
+      sim.failnext(0x81, failure)
+   ecu = pylibme7.Ecu(ser=sim, bitbang=sim.bitbangdevice)
+   devnull = open(os.devnull, 'w')
+   with contextlib.redirect_stdout(devnull):
+      ecu.initialize(connect)
+   devnull.close()
+   # Idle high, low and high time of every wake-up, the high time running up to the
+   # StartCommunication that followed it
+   patterns = []
+   for edges, start in zip(sim.wakeups, sim.startrequests):
+      patterns = patterns + [ ( edges[1][0] - edges[0][0], edges[2][0] - edges[1][0], start[0] - edges[2][0] ) ]
+   return { 'connected': ecu.ecuconnect, 'patterns': patterns, 'targets': [ start[1] for start in sim.startrequests ] }
+
+def fastinitcheck():
+   # Returns True when every fast init check passes
+   checks = []
+
+   # W5 300 ms idle, TiniL 25 ms, TiniH 25 ms before StartCommunication
+   result = fastinitrun('FAST')
+   idle, low, high = result['patterns'][0]
+   checks = checks + [ ( 'wake-up timing', result['connected'] and len(result['patterns']) == 1 and
+                         idle >= .3 and .024 <= low <= .030 and .025 <= high <= .060,
+                         "idle " + str(round(idle * 1000, 1)) + " ms, low " + str(round(low * 1000, 1)) +
+                         " ms, high " + str(round(high * 1000, 1)) + " ms" ) ]
+
+   # A retry starts over with a full W5 idle too
+   for name, failure in [ ( 'dropped response', None ), ( 'rejected (0x22)', 0x22 ) ]:
+      result = fastinitrun('FAST', failure=failure)
+      idles = [ pattern[0] for pattern in result['patterns'] ]
+      checks = checks + [ ( name, result['connected'] and len(idles) == 2 and idles[1] >= .3,
+                            str(len(idles)) + " attempts, retry idle " + str(round(idles[-1] * 1000, 1)) + " ms" ) ]
+
+   # FAST-0xNN talks to ECU address NN
+   result = fastinitrun('FAST-0x11', address=0x11)
+   checks = checks + [ ( 'FAST-0x11 address', result['connected'] and result['targets'] == [ 0x11 ],
+                         "target " + ', '.join([ hex(target) for target in result['targets'] ]) ) ]
+
+   passed = True
+   for name, ok, detail in checks:
+      print(name.ljust(22) + ("ok" if ok else "FAILED").ljust(8) + detail)
+      passed = passed and ok
+   return passed
+
+def main():
+   argparser = argparse.ArgumentParser()
+   argparser.add_argument("-n", "--records", type=int, default=500, help="Records per run")
+   argparser.add_argument("-v", "--variables", type=int, default=10, help="Variables in the log record")
+   argparser.add_argument("--baud", type=int, default=250000, choices=sorted(pylibme7.Ecu.baudcodes), help="Session baud rate")
+   argparser.add_argument("--rate", type=int, default=0, help="SamplesPerSecond, 0 logs as fast as possible")
+   argparser.add_argument("--nodelay", action="store_true", help="Don't simulate time on the wire, only host overhead is left")
+   mode = argparser.add_mutually_exclusive_group()
+   mode.add_argument("--suite", action="store_true", help="Run plain, pipelined, threaded and both (the default)")
+   mode.add_argument("-p", "--pipeline", action="store_true", help="Only the pipelined loop")
+   mode.add_argument("-b", "--buffer", type=int, default=0, help="Only the threaded loop with this queue size")
+   mode.add_argument("--fastinit", action="store_true", help="Check the fast init and StartCommunication instead")
+   argparser.add_argument("--min-rate", type=float, default=0, help="Exit with status 1 if a run logs fewer records/sec")
+   args = argparser.parse_args()
+
+   if args.fastinit:
+      if not fastinitcheck():
+         sys.exit(1)
+      return
+
+   if args.pipeline:
+      runs = [ ( 'pipelined', True, 0 ) ]
+   elif args.buffer > 0:
+      runs = [ ( 'threaded', False, args.buffer ) ]
+   else:
+      runs = [ ( 'plain', False, 0 ), ( 'pipelined', True, 0 ), ( 'threaded', False, 64 ), ( 'pipelined+threaded', True, 64 ) ]
+
+   print(str(args.records) + " records, " + str(args.variables) + " variables, " + str(args.baud) + " baud" +
+         (", no wire delay" if args.nodelay else ""))
+   print("run".ljust(22) + "records".rjust(7) + "rec/s".rjust(10) + "p50 ms".rjust(9) + "p95 ms".rjust(9) +
+         "p99 ms".rjust(9) + "max ms".rjust(9) + "cpu us/r".rjust(10) + "writes".rjust(7))
+   slow = False
+   for name, pipelined, buffer in runs:
+      result = benchrun(args.records, args.variables, args.baud, args.rate, not args.nodelay, pipelined, buffer)
+      report(name, result)
+      if result['rate'] < args.min_rate:
+         slow = True
+   if slow:
+      print("Below --min-rate of " + str(args.min_rate) + " records/sec")
+      sys.exit(1)
+
+if __name__ == '__main__':
+
+   try:
+     main()
+
+   except KeyboardInterrupt:
+     print("Ctrl-c")
@@ -3,7 +3,13 @@
 '''
 pylibme7
 - a very basic python object for interacting with Bosch ME7 ECU's
-- requires pylibftdi
+- requires pylibftdi, unless another device is handed to Ecu()
+
+Ecu() talks to anything with the pylibftdi Device interface: open(), close(),
+flush(), read(n), write(data), a baudrate attribute and
+ftdi_fn.ftdi_set_line_property().  The bit bang side needs the BitBangDevice
+interface: open(), close() and the direction and port attributes.  simecu.py
+has stand-ins for both.
 
 
 Copyright 2013 Ted Richardson.
@@ -30,11 +36,15 @@ trichard3000
 from __future__ import print_function, division
 import sys
 import time
+import struct
 import argparse
 # This may need to be installed separately
-from pylibftdi import Device, BitBangDevice
+try:
+    from pylibftdi import Device, BitBangDevice
+except ImportError:
+    Device = BitBangDevice = None
 
-debug = 4
+debug = 0   # mmll.py sets this from its --debug option
 
 def hexlist(hexlist):
    result = ""
@@ -42,14 +52,122 @@ def hexlist(hexlist):
       result += '0x{0:0{1}X} '.format(value,2)
    return result
 
-class Ecu:
+class Histogram:
+    # Streaming latency histogram in ns.  Buckets are powers of two split 16 ways,
+    # so percentiles are good to about 6% without keeping every sample.
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.max = 0
+
+    def add(self, ns):
+        shift = max(ns.bit_length() - 5, 0)
+        key = (shift << 5) + (ns >> shift)
+        self.buckets[key] = self.buckets.get(key, 0) + 1
+        self.count = self.count + 1
+        if ns > self.max:
+            self.max = ns
+
+    def percentile(self, pct):
+        # Upper edge of the bucket holding the pct percentile, never above the max seen
+        wanted = self.count * pct / 100
+        seen = 0
+        for key in sorted(self.buckets):
+            seen = seen + self.buckets[key]
+            if seen >= wanted:
+                shift = key >> 5
+                return min(((key & 0x1F) + 1) << shift, self.max)
+        return self.max
+
+class PhaseTimer:
+    # Per-phase timings of the log cycle, one Histogram per phase
+    phases = ["request write", "echo", "length byte", "response body", "checksum", "decode", "output write"]
 
     def __init__(self):
-        self.ser = Device(mode='b', lazy_open=True)
+        self.histograms = {}
+
+    def add(self, phase, ns):
+        if phase not in self.histograms:
+            self.histograms[phase] = Histogram()
+        self.histograms[phase].add(ns)
+
+    def report(self):
+        lines = ["phase".ljust(16) + "count".rjust(9) + "p50 us".rjust(10) + "p95 us".rjust(10) + "p99 us".rjust(10) + "max us".rjust(10)]
+        names = [phase for phase in self.phases if phase in self.histograms]
+        names = names + sorted([phase for phase in self.histograms if phase not in self.phases])
+        for phase in names:
+            h = self.histograms[phase]
+            lines.append(phase.ljust(16) + str(h.count).rjust(9) +
+                         "".join([str(round(value / 1000, 1)).rjust(10) for value in
+                                  [h.percentile(50), h.percentile(95), h.percentile(99), h.max]]))
+        return "\n".join(lines)
+
+class BusTrace:
+    # Compact binary record of the K-line traffic.  Each entry is a direction byte
+    # (b'T' sent, b'R' received), an 8 byte ns timestamp since the trace started,
+    # a 2 byte length and then the bytes themselves, all little-endian.
+    entry = struct.Struct('<cQH')
+
+    def __init__(self, tracefile):
+        self.tracefile = tracefile
+        self.start = time.perf_counter_ns()
+
+    def record(self, direction, data):
+        self.tracefile.write(self.entry.pack(direction, time.perf_counter_ns() - self.start, len(data)) + bytes(data))
+
+    def flush(self):
+        self.tracefile.flush()
+
+def readtrace(tracefile):
+    # Yields (direction, ns, bytes) for every entry in a BusTrace file
+    while True:
+        head = tracefile.read(BusTrace.entry.size)
+        if len(head) < BusTrace.entry.size:
+            return
+        direction, ns, length = BusTrace.entry.unpack(head)
+        yield direction, ns, tracefile.read(length)
+
+class EcuTimeout(Exception):
+    # Raised when the ECU doesn't deliver the expected bytes before the deadline
+    pass
+
+class Ecu:
+
+    def __init__(self, ser=None, bitbang=None):
+        # ser and bitbang replace the FTDI serial device and the BitBangDevice class
+        if ser is None:
+            if Device is None:
+                raise Exception("pylibftdi is required to talk to a real ECU")
+            ser = Device(mode='b', lazy_open=True)
+        if bitbang is None:
+            bitbang = BitBangDevice
+        self.ser = ser
+        self.bitbang = bitbang
+        # Count of writes handed to the FTDI device, total and for the last command
+        self.writecount = 0
+        self.lastwrites = 0
+        # Receive buffer: everything the FTDI chip hands over, consumed from rxpos
+        self.rxbuf = bytearray()
+        self.rxpos = 0
+        self.readsize = 1024
+        # Seconds recv() waits for the ECU before raising EcuTimeout
+        self.timeout = 2.0
+        # Longest nap between reads of an idle device
+        self.maxidle = 0.005
+        # KWP2000 P3min: quiet time between the end of a response and the next request.
+        # 0 matches what the logger has always done; raise it for picky ECUs.
+        self.p3min = 0.0
+        self.lastresponse = 0.0
+        # Raise on response checksum errors instead of passing the data on
+        self.verifychecksum = False
+        # A PhaseTimer here gets the timing of every request/response phase
+        self.phases = None
+        # A BusTrace here gets every byte sent and received
+        self.trace = None
 
     def slowInit11(self):
         # Take the one-byte address to "bit bang" and bang the port
-        self.bbser = BitBangDevice()
+        self.bbser = self.bitbang()
         print("beginning slow init")
         self.bbser.open()
         self.bbser.direction = 0x01
@@ -66,6 +184,50 @@ class Ecu:
         self.bbser.close()
         print("slow init sent")
 
+    def fastInit(self, idle=.3):
+        # ISO 14230 fast init wake-up pattern: K-line idle high, 25 ms low, 25 ms high.
+        # idle is W5, the 300 ms the bus has to be quiet before every pattern.
+        # Returns the time the wake-up pattern ends.  The high half overlaps reopening the
+        # serial side, the caller sleeps whatever is left of it.
+        self.bbser = self.bitbang()
+        print("beginning fast init")
+        self.bbser.open()
+        self.bbser.direction = 0x01
+        self.bbser.port = 1
+        time.sleep(idle)    # W5, the bus has to be idle before the pattern
+        self.bbser.port = 0
+        time.sleep(.025)    # TiniL
+        self.bbser.port = 1
+        wakeupend = time.monotonic() + .025
+        self.bbser.close()
+        return wakeupend
+
+    def startcommunication(self, target):
+        # ISO 14230 StartCommunication with physical addressing, sent after fastInit().
+        # Returns the key bytes from the positive response.
+        request = [0x81, target, 0xF1, 0x81]
+        request = request + [sum(request) & 0xFF]
+        self.send(request)
+        if self.recv(len(request), 0.1) != bytes(request):
+            raise Exception("startCommunication echo mismatch", request)
+        # Format byte, then address bytes if the format says so, then an extra length byte
+        # when the length bits are zero
+        fmt = self.recv(1, 0.1)[0]
+        header = [fmt]
+        if fmt & 0xC0:
+            header = header + list(self.recv(2, 0.1))
+        length = fmt & 0x3F
+        if length == 0:
+            length = self.recv(1, 0.1)[0]
+            header = header + [length]
+        recvdata = self.recv(length + 1, 0.1)
+        response = header + list(recvdata[:-1])
+        if (sum(response) & 0xFF) != recvdata[-1]:
+            raise Exception("startCommunication checksum error", response)
+        if recvdata[0] != 0xC1:
+            raise Exception("startCommunication rejected", response)
+        return list(recvdata[1:-1])
+
     def initialize(self, connect):
         self.connect = connect
         if self.connect == "SLOW-0x11":
@@ -82,6 +244,7 @@ class Ecu:
                 self.ser.ftdi_fn.ftdi_set_line_property(8, 1, 0)
                 self.ser.baudrate = 10400
                 self.ser.flush()
+                self.clearrecv()
 
                 # Wait for ECU response to bit bang
                 waithex = [0x55, 0xef, 0x8f, 1]
@@ -106,6 +269,39 @@ class Ecu:
                     return
                 print("INIT done")
 
+        elif self.connect.startswith("FAST"):
+            # FAST or FAST-0xNN, NN being the ECU address (0x01 if not given)
+            if len(self.connect) > 5:
+                target = int(self.connect[5:], 16)
+            else:
+                target = 0x01
+            self.ser.close()
+
+            self.ecuconnect = False
+            while self.ecuconnect == False:
+                print("Attempting ECU connect: " + self.connect)
+
+                wakeupend = self.fastInit()
+                self.ser.open()
+                self.ser.ftdi_fn.ftdi_set_line_property(8, 1, 0)
+                self.ser.baudrate = 10400
+                self.ser.flush()
+                self.clearrecv()
+                remaining = wakeupend - time.monotonic()
+                if remaining > 0:
+                    time.sleep(remaining)
+
+                try:
+                    keybytes = self.startcommunication(target)
+                    print(f"ecu connection key bytes: {hexlist(keybytes)}")
+                    self.ecuconnect = True
+                except Exception as e:
+                    print("ECU Connect Failed (" + str(e.args[0]) + ").  Retrying.")
+            print("INIT done")
+
+        else:
+            raise Exception("unsupported Connect mode", self.connect)
+
     def waitfor(self, wf):
         # This was used for debugging and really is only used for the init at this point.
         # wf should be a list with the timeout in the last element
@@ -115,11 +311,13 @@ class Ecu:
         foundlist = []
         capturebytes = []
         to = self.wf[-1]
-        timecheck = time.time()
-        while (time.time() <= (timecheck+to)) & (isfound == False):
+        timecheck = time.monotonic()
+        while (time.monotonic() <= (timecheck+to)) & (isfound == False):
             try:
                 recvbyte = self.recvraw(1)
-                if recvbyte != b"":
+                if recvbyte == b"":
+                    self.waitdata(timecheck + to)
+                else:
                     recvdata = ord(recvbyte)
                     capturebytes = capturebytes + [recvdata]
                     if recvdata == self.wf[idx]:
@@ -138,46 +336,107 @@ class Ecu:
 
     def send(self, sendlist):
         self.sendlist = sendlist
-        # Puts every byte in the sendlist out the serial port
-        for i in self.sendlist:
-            self.ser.write(chr(i))
+        # Puts the whole sendlist out the serial port in a single write
+        self.ser.write(bytes(self.sendlist))
+        self.writecount = self.writecount + 1
+        if self.trace is not None:
+            self.trace.record(b'T', self.sendlist)
+
+    def clearrecv(self):
+        # Throws away anything left in the receive buffer
+        self.rxbuf = bytearray()
+        self.rxpos = 0
+
+    def buffered(self):
+        # Number of received bytes not yet consumed
+        return len(self.rxbuf) - self.rxpos
+
+    def fill(self):
+        # Drains whatever the FTDI chip has in one read and appends it to the receive buffer
+        if self.rxpos > 0 and self.rxpos >= len(self.rxbuf) // 2:
+            # Compact the consumed front of the buffer before it grows
+            del self.rxbuf[:self.rxpos]
+            self.rxpos = 0
+        recvdata = self.ser.read(self.readsize)
+        if recvdata:
+            self.rxbuf += recvdata
+            if self.trace is not None:
+                self.trace.record(b'R', recvdata)
+        return len(recvdata)
+
+    def take(self, count):
+        # Slices count bytes off the front of the receive buffer
+        recvdata = bytes(self.rxbuf[self.rxpos:self.rxpos + count])
+        self.rxpos = self.rxpos + len(recvdata)
+        return recvdata
 
     def recvraw(self, bytes):
+        # Returns up to the requested number of bytes without waiting
         self.bytes = bytes
-        recvdata = self.ser.read(self.bytes)
-        return recvdata
-
-    def recv(self, bytes):
+        if self.buffered() == 0:
+            self.fill()
+        return self.take(self.bytes)
+
+    def waitdata(self, deadline):
+        # Waits until the device has something for the receive buffer or the deadline passes.
+        # Idle polls back off from one byte time at the current baud rate up to maxidle
+        # so a quiet bus doesn't keep a core busy.
+        nap = 10 / self.ser.baudrate
+        while self.fill() == 0:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(nap, remaining))
+            nap = min(nap * 2, self.maxidle)
+        return True
+
+    def recv(self, bytes, timeout=None):
+        # Returns exactly the requested number of bytes, or raises EcuTimeout
         self.bytes = bytes
-        isread = False
-        while isread == False:
-            recvbyte = self.ser.read(self.bytes)
-            if recvbyte != b"":
-                recvdata = recvbyte
-                isread = True
-        return recvdata
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.monotonic() + timeout
+        while self.buffered() < self.bytes:
+            if not self.waitdata(deadline):
+                raise EcuTimeout("timeout", self.bytes, self.take(self.buffered()))
+        return self.take(self.bytes)
+
+    def buildframe(self, sendlist):
+        # Wraps raw KWP command in a length byte and a checksum byte, all in one buffer
+        frame = bytearray(len(sendlist) + 2)
+        frame[0] = len(sendlist)
+        frame[1:-1] = sendlist
+        frame[-1] = self.checksum(frame[:-1])
+        return frame
 
     def sendcommand(self, sendlist):
-        # Wraps raw KWP command in a length byte and a checksum byte and hands it to send()
-        self.sendlist = sendlist
-        csum = 0
-        self.sendlist = [len(self.sendlist)] + self.sendlist
-        csum = self.checksum(self.sendlist)
-        self.sendlist = self.sendlist + [csum]
+        # Frames the raw KWP command and hands it to send() as a single write
+        writesbefore = self.writecount
+        self.sendlist = self.buildframe(sendlist)
+        if self.p3min > 0:
+            quiet = time.monotonic() - self.lastresponse
+            if quiet < self.p3min:
+                time.sleep(self.p3min - quiet)
+        phases = self.phases
+        if phases is not None:
+            start = time.perf_counter_ns()
         self.send(self.sendlist)
-        print(f"sendcommand() sent: {hexlist(self.sendlist)}")
+        if phases is not None:
+            sent = time.perf_counter_ns()
+            phases.add("request write", sent - start)
+        self.lastwrites = self.writecount - writesbefore
+        if debug >= 4:
+            print(f"sendcommand() sent: {hexlist(self.sendlist)}")
         cmdval = self.commandvalidate(self.sendlist)
+        if phases is not None:
+            phases.add("echo", time.perf_counter_ns() - sent)
         return cmdval
 
     def commandvalidate(self, command):
         # Every KWP command is echoed back.  This clears out these bytes.
         self.command = command
-        cv = True
-        for i in range(len(self.command)):
-            recvdata = self.recv(1)
-            if ord(recvdata) != self.command[i]:
-                cv = cv & False
-        return cv
+        recvdata = self.recv(len(self.command))
+        return recvdata == bytes(self.command)
 
     def checksum(self, checklist):
         # Calculates the simple checksum for the KWP command bytes.
@@ -194,23 +453,38 @@ class Ecu:
         # gets a properly formated KWP response from a command and returns the data.
         debugneeds = 4
         numbytes = 0
+        phases = self.phases
+        if phases is not None:
+            start = time.perf_counter_ns()
         # This is a hack because sometimes responses have leading 0x00's.  Why?  This removes them.
         while numbytes == 0:
             numbytes = ord(self.recv(1))
-        gr = [numbytes]
+        if phases is not None:
+            lengthbyte = time.perf_counter_ns()
+            phases.add("length byte", lengthbyte - start)
         if debug >= debugneeds:
             print("Get bytes: " + hex(numbytes))
-        for i in range(numbytes):
-            recvdata = ord(self.recv(1))
-            if debug >= debugneeds:
-                print("Get byte" + str(i) + ": " + hex(recvdata))
-            gr = gr + [recvdata]
+        # The payload and the checksum are sliced out of the buffer by the length byte
+        gr = [numbytes] + list(self.recv(numbytes))
+        if phases is not None:
+            body = time.perf_counter_ns()
+            phases.add("response body", body - lengthbyte)
         checkbyte = self.recv(1)
+        self.lastresponse = time.monotonic()
+        if debug >= debugneeds:
+            for i in range(numbytes):
+                print("Get byte" + str(i) + ": " + hex(gr[i + 1]))
         if debug >= debugneeds:
             print(f"getresponse recieved: {hexlist(gr)}")
         if debug >= debugneeds:
             print("GR: " + hex(ord(checkbyte)) +
                   "<-->" + hex(self.checksum(gr)))
+        if self.verifychecksum:
+            # ECUs send the plain sum, checksum() folds 0xFF to 0x00; take either
+            if ord(checkbyte) != (sum(gr) & 0xFF) and ord(checkbyte) != self.checksum(gr):
+                raise Exception("checksumError", gr)
+        if phases is not None:
+            phases.add("checksum", time.perf_counter_ns() - body)
         if(gr[1]==0x7f):
             return { # returning the result so 0x78 (responsePending) can re-execute
                 0x10: lambda: self._raise(Exception("generalReject", gr)),
@@ -246,11 +520,24 @@ class Ecu:
             }.get(gr[3], lambda: self._raise( Exception("Generic KWP negative response", gr)))()
         return gr
 
-    def readecuid(self, paramdef):
+    def idsession(self):
+        # setup diag session for reading IDs.  The reply has to be read so it doesn't
+        # pass for the next response; an ECU that turns the session down may still
+        # give up its IDs, so a negative reply isn't an error here.
+        self.sendcommand([0x10, 0x85])
+        try:
+            return self.getresponse()
+        except EcuTimeout:
+            raise
+        except Exception:
+            return None
+
+    def readecuid(self, paramdef, session=True):
         #KWP2000 command to pull the ECU ID
         self.paramdef = paramdef
         debugneeds = 3
-        response = self.sendcommand([0x10, 0x85]) # setup diag session
+        if session:
+            self.idsession()
         reqserviceid = [0x1A]
         sendlist = reqserviceid + self.paramdef
         if debug >= debugneeds:
@@ -261,6 +548,20 @@ class Ecu:
             print(f"readecuid got: {hexlist(response)}")
         return response
 
+    def readecuids(self, paramdefs, session=True):
+        # Pulls several ECU IDs behind a single diag session setup, or in the current
+        # session with session=False.
+        # Returns a dict of ID -> response, None for the ones the ECU wouldn't give up.
+        if session:
+            self.idsession()
+        ids = {}
+        for paramdef in paramdefs:
+            try:
+                ids[paramdef] = self.readecuid([paramdef], session=False)
+            except Exception:
+                ids[paramdef] = None
+        return ids
+
     def securityAccessL3(self):
         ### Begin - level 3 security
         self.sendcommand([0x27,0x03])
@@ -378,37 +679,74 @@ class Ecu:
         response = self.getresponse()
         return response
 
+    # Session baud rates and the bytes startdiagsession() sends for them
+    baudcodes = {19200: 0x30, 38400: 0x50, 56000: 0x63, 57600: 0x64, 124800: 0x87, 250000: 0xA7}
+
     def startdiagsession(self, bps):
-        # KWP2000 setup that sets the baud for the logging session
+        # KWP2000 setup that sets the baud for the logging session.  0 keeps the current baud.
         self.bps = bps
         startdiagnosticsession = [0x10]
         sessionType = [0x86] 
-    #   if self.bps == 10400:
-    #      bpsout = [ 0x?? ]
-    #   if self.bps == 14400:
-    #      bpsout = [ 0x?? ]
-        if self.bps == 19200:
-            bpsout = [0x30]
-        if self.bps == 38400:
-            bpsout = [0x50]
-        if self.bps == 56000:
-            bpsout = [0x63]
-        if self.bps == 57600:
-            bpsout = [0x64]
-        if self.bps == 124800:
-            bpsout = [0x87]
-        if self.bps == 250000:
-            bpsout = [0xA7]
+    #   10400 and 14400 codes are unknown
         if(self.bps != 0):
-            sendlist = startdiagnosticsession + sessionType + bpsout
+            if self.bps not in self.baudcodes:
+                raise Exception("unsupported LogSpeed", self.bps)
+            sendlist = startdiagnosticsession + sessionType + [self.baudcodes[self.bps]]
         else:
             sendlist = startdiagnosticsession + sessionType
         self.sendcommand(sendlist)
         response = self.getresponse()
-        self.ser.baudrate = self.bps
+        if(self.bps != 0):
+            self.ser.baudrate = self.bps
         time.sleep(1)
         return response
 
+    def probebaud(self, bps, logline, records):
+        # Switches the session to bps, sets up the log record and times a burst of records.
+        # Returns records/sec.  Echo, framing, checksum and timeout problems all raise.
+        self.startdiagsession(bps)
+        for attempt in range(5):
+            try:
+                self.setuplogrecord(logline)
+                break
+            except Exception as e:
+                if e.args[0] != "busyRepeatRequest" or attempt == 4:
+                    raise
+        verify = self.verifychecksum
+        self.verifychecksum = True
+        try:
+            start = time.perf_counter()
+            for i in range(records):
+                if not self.requestlogrecord():
+                    raise Exception("echoMismatch", bps)
+                response = self.readlogrecord()
+                if response[1] != 0xF7:
+                    raise Exception("unexpectedResponse", response)
+            return records / (time.perf_counter() - start)
+        finally:
+            self.verifychecksum = verify
+
+    def negotiatebaud(self, logline, rates=None, records=20, reconnect=None):
+        # Tries the session baud rates fastest first and settles on the first one that
+        # gets a clean burst of log records through.  reconnect() is called after a
+        # failed rate to bring the ECU back to the init baud rate.
+        # Returns the chosen rate and a dict of rate -> records/sec (None if it failed).
+        if rates is None:
+            rates = self.baudcodes.keys()
+        results = {}
+        for bps in sorted(rates, reverse=True):
+            try:
+                results[bps] = self.probebaud(bps, logline, records)
+                print(f"{bps} baud: {round(results[bps], 1)} records/sec")
+                return bps, results
+            except Exception as e:
+                results[bps] = None
+                print(f"{bps} baud: failed ({e.args[0]})")
+                self.clearrecv()
+                if reconnect is not None:
+                    reconnect()
+        raise Exception("baudNegotiationFailed", results)
+
     def accesstimingparameter(self, params):
         # KWP2000 command to access timing parameters
         self.params = params
@@ -465,23 +803,40 @@ class Ecu:
         response = self.getresponse()
         return response
 
+    def requestlogrecord(self):
+        # First half of getlogrecord(): puts the request on the wire and clears the echo
+        gr = [0xb7]
+        return self.sendcommand(gr)
+
+    def readlogrecord(self):
+        # Second half of getlogrecord(): collects the response to requestlogrecord()
+        return self.getresponse()
+
     def getlogrecord(self):
         # Command to request a logging record
-        gr = [0xb7]
-        self.sendcommand(gr)
-        response = self.getresponse()
+        self.requestlogrecord()
+        response = self.readlogrecord()
         return response
 
     def sendhexstring(self, dumpstring):
         # Takes a list of characters as a string, turns every two characters into a hex byte and sends it raw.
         # used as needed for dev/test/debug
         self.dumpstring = dumpstring
-        for i in range(len(self.dumpstring)/2):
-            self.send([int('0x'+self.dumpstring[i*2:(i*2)+2], 16)])
+        self.send(bytes.fromhex(self.dumpstring))
 
 
 def main():
-    print("Loading pylibme7")
+    # Prints a bus trace written with --trace
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("tracefile", nargs='?', help="A bus trace file to print")
+    args = argparser.parse_args()
+    if args.tracefile is None:
+        print("Loading pylibme7")
+        return
+    tracefile = open(args.tracefile, 'rb')
+    for direction, ns, data in readtrace(tracefile):
+        print(str(round(ns / 1e6, 3)).rjust(12) + " " + direction.decode() + " " + hexlist(data))
+    tracefile.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,140 @@
+#!/usr/bin/python
+
+'''
+rawlog.py
+- raw binary capture files for mmll.py, and a converter to ME7Logger style logs
+
+usage: rawlog.py [-h] [-o OUTPUTFILE] [-f {csv,npy,parquet}] RAWFILE
+
+RAWFILE may be compressed with mmll.py --compress (.gz, .xz or .zst).
+
+A raw capture keeps the decoding out of the logging loop.  The file starts with
+a magic string and a length-prefixed JSON header holding the parsed config, the
+setuplogrecord() payload from loglocations() and the record width.  After that
+every record is a fixed-width block: an 8 byte little-endian nanosecond
+timestamp since the start of logging, then the getlogrecord() response as
+received.
+
+Copyright 2013 Ted Richardson.
+Distributed under the terms of the GNU General Public License (GPL)
+See LICENSE.txt for licensing information.
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program; if not, write to the Free Software Foundation, Inc.,
+51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+--
+trichard3000
+'''
+
+import sys, time, argparse, struct, json
+import compresslog
+
+magic = b'MMLLRAW1'
+stamp = struct.Struct('<Q')
+
+class RawWriter:
+   # Appends fixed-width timestamped log records to a raw capture file
+
+   def __init__(self, rawfile, config, locations):
+      self.rawfile = rawfile
+      # Length byte + 0xF7 + the logged bytes
+      self.recordsize = config[0][12] + 2
+      self.record = bytearray(stamp.size + self.recordsize)
+      self.dropped = 0
+      self.starttime = time.time()
+      self.startns = time.perf_counter_ns()
+      header = json.dumps({ 'config': config, 'locations': list(locations),
+                            'recordsize': self.recordsize, 'starttime': self.starttime }).encode()
+      self.rawfile.write(magic + struct.pack('<I', len(header)) + header)
+
+   def write(self, logdata, elapsedns=None):
+      # The hot path: one timestamp, one copy into the preallocated record, one write
+      if len(logdata) != self.recordsize:
+         self.dropped = self.dropped + 1
+         return
+      if elapsedns is None:
+         elapsedns = time.perf_counter_ns() - self.startns
+      stamp.pack_into(self.record, 0, elapsedns)
+      self.record[stamp.size:] = bytes(logdata)
+      self.rawfile.write(self.record)
+
+   def flush(self):
+      self.rawfile.flush()
+
+def readheader(rawfile):
+   # Returns the header dictionary of an open raw capture file
+   if rawfile.read(len(magic)) != magic:
+      raise Exception("not an mmll raw capture file")
+   headersize = struct.unpack('<I', rawfile.read(4))[0]
+   return json.loads(rawfile.read(headersize).decode())
+
+def readrecords(rawfile, header):
+   # Yields (seconds since start, record bytes) for every complete record in the file
+   width = stamp.size + header['recordsize']
+   while True:
+      block = rawfile.read(width)
+      if len(block) < width:
+         return
+      yield stamp.unpack_from(block)[0] / 1e9, block[stamp.size:]
+
+def convert(rawfile, outfile, format='csv'):
+   # Turns a raw capture into the same log mmll.py writes when logging directly.
+   # A columnar format needs a binary outfile.
+   from me7lconfig import logheader
+   from mmll import LogDecoder, CsvEmitter
+   import columnlog
+   header = readheader(rawfile)
+   config = header['config']
+   decoder = LogDecoder(config)
+   if format == 'csv':
+      for line in logheader(config, header['starttime']):
+         outfile.write(line + '\n')
+      emitter = CsvEmitter(outfile, decoder.width, flushtime=60)
+   else:
+      emitter = columnlog.openemitter(format, outfile, config, 60, header['starttime'])
+   for elapsed, logdata in readrecords(rawfile, header):
+      emitter.add(elapsed, decoder.decode(logdata))
+   emitter.close()
+   return emitter.written
+
+def main():
+   argparser = argparse.ArgumentParser()
+   argparser.add_argument("rawfile", help="The raw capture written by mmll.py --raw")
+   argparser.add_argument("-o", "--outputfile", help="The desired output log file - No entry outputs log data to STDOUT")
+   argparser.add_argument("-f", "--format", choices=['csv', 'npy', 'parquet'], default='csv', help="ME7Logger style CSV, or a columnar OUTPUTFILE; see columnlog.py")
+   args = argparser.parse_args()
+   if args.format != 'csv' and args.outputfile is None:
+      argparser.error("--format " + args.format + " needs an OUTPUTFILE")
+
+   # Compressed captures are read as they are
+   rawfile = compresslog.openread(args.rawfile)
+   if args.format != 'csv':
+      outfile = open(args.outputfile, 'wb')
+   elif args.outputfile is not None:
+      outfile = open(args.outputfile, 'w')
+   else:
+      outfile = sys.stdout
+   count = convert(rawfile, outfile, args.format)
+   rawfile.close()
+   outfile.flush()
+   if args.outputfile is not None:
+      outfile.close()
+      print("Converted " + str(count) + " records")
+
+if __name__ == '__main__':
+
+   try:
+     main()
+
+   except KeyboardInterrupt:
+     print("Ctrl-c")
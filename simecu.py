@@ -0,0 +1,298 @@
+#!/usr/bin/python
+
+'''
+simecu
+- an in-process stand-in for an FTDI cable plugged into an ME7/EDC16 ECU
+
+SimEcu looks like a pylibftdi Device to pylibme7.Ecu and answers like the ECU
+on the other end of the K-line:
+
+    sim = SimEcu()
+    ecu = pylibme7.Ecu(ser=sim, bitbang=sim.bitbangdevice)
+
+It echoes every byte, answers the slow and fast init patterns banged through
+SimBitBang, and handles the services the logger and memdump.py use: 0x10,
+0x1A, 0x27, 0x3E, 0x82, 0x83, 0x23, 0x3D and the 0xB7 log record setup and read.  Bytes only
+become readable once they would have made it across the wire at the session
+baud rate, so timings are close to a real bus.  failnext() queues negative
+responses.  The edges of every wake-up pattern and the time of every
+StartCommunication are kept in wakeups and startrequests.  RAM is 64k mirrored
+over the whole address space.
+
+Copyright 2013 Ted Richardson.
+Distributed under the terms of the GNU General Public License (GPL)
+See LICENSE.txt for licensing information.
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program; if not, write to the Free Software Foundation, Inc.,
+51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+--
+trichard3000
+'''
+
+import time
+from collections import deque
+import pylibme7
+
+class SimLineProperty:
+    # The little bit of ftdi_fn that pylibme7 calls
+    def ftdi_set_line_property(self, bits, stopbits, parity):
+        return 0
+
+class SimBitBang:
+    # Stand-in for pylibftdi.BitBangDevice.  Every K-line level change goes to the SimEcu.
+    def __init__(self, sim):
+        self.sim = sim
+        self.direction = 0
+        self.level = 1
+
+    def open(self):
+        pass
+
+    def close(self):
+        self.sim.wakeup()
+
+    @property
+    def port(self):
+        return self.level
+
+    @port.setter
+    def port(self, level):
+        self.level = level
+        self.sim.edges.append((time.monotonic(), level))
+
+class SimEcu:
+
+    def __init__(self, bytedelay=True, p2=0.0, maxbaud=None, ids=None, address=0x01, maxread=254):
+        # bytedelay: hold bytes back for their time on the wire
+        # p2: ECU think time between a request and its response
+        # maxbaud: session rates above this corrupt every response checksum, like a bad cable
+        # maxread: largest readmembyaddr() the ECU answers, bigger ones get requestOutOfRange
+        self.bytedelay = bytedelay
+        self.maxread = maxread
+        self.p2 = p2
+        self.maxbaud = maxbaud
+        self.address = address
+        self.ids = ids
+        if self.ids is None:
+            self.ids = {0x87: b"0261206110", 0x91: b"8D0907551A  ", 0x9b: b"8D0907551A  0002", 0x9c: b"\x00\x01\x02"}
+        self.baudcodes = dict([(code, bps) for bps, code in pylibme7.Ecu.baudcodes.items()])
+        self.baudrate = 10400       # host side, set by pylibme7
+        self.ecubaud = 10400        # ECU side
+        self.ftdi_fn = SimLineProperty()
+        self.memory = bytearray(0x10000)
+        self.layout = None         # the 0xB7 layout, once one is set up
+        self.failures = {}
+        self.edges = []
+        self.wakeups = []           # the edges of every wake-up pattern, for checking timings
+        self.startrequests = []     # (time, target address) of every StartCommunication
+        self.pending = None         # 'slow' or 'fast' once a wake-up pattern was seen
+        self.inbuf = bytearray()
+        self.rx = deque()           # (time readable, byte)
+        self.linefree = 0.0
+        self.requests = 0
+        self.isopen = False
+
+    # pylibftdi Device interface
+
+    def open(self):
+        self.isopen = True
+        if self.pending == 'slow':
+            # Sync byte and key bytes, W1 after the address byte
+            self.pending = None
+            self.ecubaud = 10400
+            self.emit([0x55, 0xEF, 0x8F], time.monotonic() + 0.02)
+
+    def close(self):
+        self.isopen = False
+
+    def flush(self):
+        now = time.monotonic()
+        while self.rx and self.rx[0][0] <= now:
+            self.rx.popleft()
+        self.inbuf = bytearray()
+
+    def write(self, data):
+        data = bytes(data)
+        # The echo of our own bytes comes back at the host's rate
+        self.emit(data, time.monotonic(), self.baudrate)
+        self.inbuf += data
+        self.process()
+        return len(data)
+
+    def read(self, count):
+        now = time.monotonic()
+        out = bytearray()
+        while self.rx and len(out) < count and self.rx[0][0] <= now:
+            out.append(self.rx.popleft()[1])
+        return bytes(out)
+
+    def bitbangdevice(self):
+        # Hand this to pylibme7.Ecu(bitbang=...)
+        return SimBitBang(self)
+
+    # Knobs
+
+    def failnext(self, service, code):
+        # The next request for service gets a negative response with this code.
+        # 0x78 (responsePending) is followed by the real answer.  For StartCommunication
+        # (0x81) a code of None drops the response altogether.
+        self.failures.setdefault(service, []).append(code)
+
+    def poke(self, address, data):
+        for i in range(len(data)):
+            self.memory[(address + i) & 0xFFFF] = data[i]
+
+    def peek(self, address, size):
+        return bytes([self.memory[(address + i) & 0xFFFF] for i in range(size)])
+
+    # The ECU side
+
+    def bytetime(self, baud):
+        if not self.bytedelay:
+            return 0.0
+        return 10 / baud
+
+    def emit(self, data, start, baud=None):
+        # Queues bytes on the K-line, one byte time apart, after whatever is already there
+        if baud is None:
+            baud = self.ecubaud
+        t = max(start, self.linefree)
+        for b in data:
+            t = t + self.bytetime(baud)
+            self.rx.append((t, b))
+        self.linefree = t
+
+    def wakeup(self):
+        # Looks at the K-line edges banged so far for a slow or fast init pattern
+        lows = []
+        for i in range(1, len(self.edges)):
+            if self.edges[i - 1][1] == 0 and self.edges[i][1] == 1:
+                lows.append(self.edges[i][0] - self.edges[i - 1][0])
+        self.wakeups.append(self.edges)
+        self.edges = []
+        if not lows:
+            return
+        if max(lows) > 0.1:
+            self.pending = 'slow'
+        elif 0.015 <= lows[-1] <= 0.04:
+            self.pending = 'fast'
+        self.ecubaud = 10400
+        self.layout = None
+
+    def respond(self, payload):
+        frame = [len(payload)] + list(payload)
+        csum = sum(frame) & 0xFF
+        if self.maxbaud is not None and self.ecubaud > self.maxbaud:
+            csum = csum ^ 0x01
+        self.emit(frame + [csum], self.linefree + self.p2)
+
+    def process(self):
+        # Pulls complete requests out of what the host wrote
+        while self.inbuf:
+            if self.pending == 'fast' and self.inbuf[0] == 0x81:
+                if len(self.inbuf) < 5:
+                    return
+                request = self.inbuf[:5]
+                del self.inbuf[:5]
+                self.startrequests.append((time.monotonic(), request[1]))
+                if request[3] == 0x81 and request[1] == self.address:
+                    response = [0x83, 0xF1, self.address, 0xC1, 0xEF, 0x8F]
+                    if self.failures.get(0x81):
+                        code = self.failures[0x81].pop(0)
+                        if code is None:
+                            continue
+                        response = [0x83, 0xF1, self.address, 0x7F, 0x81, code]
+                    self.pending = None
+                    self.emit(response + [sum(response) & 0xFF], self.linefree + 0.025)
+                continue
+            if self.inbuf[0] == 0x70 and len(self.inbuf) == 1:
+                # Complement of key byte 2 after a slow init, answered with the complemented address
+                del self.inbuf[:1]
+                self.emit([0xFE], self.linefree + 0.025)
+                continue
+            length = self.inbuf[0]
+            if length == 0:
+                del self.inbuf[:1]
+                continue
+            if len(self.inbuf) < length + 2:
+                return
+            frame = self.inbuf[:length + 2]
+            del self.inbuf[:length + 2]
+            if self.baudrate != self.ecubaud:
+                # The ECU can't make out requests sent at the wrong rate
+                continue
+            self.service(list(frame[1:-1]))
+
+    def service(self, payload):
+        self.requests = self.requests + 1
+        sid = payload[0]
+        if self.failures.get(sid):
+            code = self.failures[sid].pop(0)
+            self.respond([0x7F, sid, code])
+            if code != 0x78:
+                return
+
+        if sid == 0x10:
+            self.respond([0x50, payload[1]])
+            if len(payload) > 2:
+                if payload[2] not in self.baudcodes:
+                    return
+                self.ecubaud = self.baudcodes[payload[2]]
+        elif sid == 0x1A:
+            if payload[1] not in self.ids:
+                self.respond([0x7F, 0x1A, 0x12])
+            else:
+                self.respond([0x5A, payload[1]] + list(self.ids[payload[1]]))
+        elif sid == 0x27:
+            if payload[1] % 2 == 1:
+                self.respond([0x67, payload[1], 0x12, 0x34, 0x56, 0x78])
+            else:
+                self.respond([0x67, payload[1], 0x34])
+        elif sid == 0x3E:
+            self.respond([0x7E])
+        elif sid == 0x82:
+            self.respond([0xC2])
+        elif sid == 0x83:
+            self.respond([0xC3, payload[1]])
+        elif sid == 0x23:
+            address = (payload[1] << 16) + (payload[2] << 8) + payload[3]
+            if payload[4] > self.maxread:
+                self.respond([0x7F, 0x23, 0x31])
+            else:
+                self.respond([0x63] + list(self.peek(address, payload[4])))
+        elif sid == 0x3D:
+            address = (payload[1] << 16) + (payload[2] << 8) + payload[3]
+            self.poke(address, payload[5:5 + payload[4]])
+            self.respond([0x7D])
+        elif sid == 0xB7:
+            if len(payload) > 1:
+                # 0x03 then three bytes per variable, 0x40 on the first one marks a word
+                self.layout = []
+                for i in range(2, len(payload) - 2, 3):
+                    size = 2 if payload[i] & 0x40 else 1
+                    address = ((payload[i] & ~0x40) << 16) + (payload[i + 1] << 8) + payload[i + 2]
+                    self.layout.append((address, size))
+                self.respond([0xF7])
+            elif self.layout is None:
+                self.respond([0x7F, 0xB7, 0x22])
+            else:
+                record = [0xF7]
+                for address, size in self.layout:
+                    record = record + list(self.peek(address, size))
+                if len(record) > 255:
+                    self.respond([0x7F, 0xB7, 0x31])
+                else:
+                    self.respond(record)
+        else:
+            self.respond([0x7F, sid, 0x11])